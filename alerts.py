@@ -0,0 +1,271 @@
+import os
+import sys
+import json
+import time
+import struct
+import argparse
+from eventlog import address
+
+# One alert: first and last hit, number of hits, rule, ports, IP protocol,
+# action, address length and the addresses (IPv4 in their first 4 bytes)
+ALERT_RECORD = struct.Struct('<ddIIHHBBBx16s16s')
+# One index entry per block of records: earliest and latest hit in the block,
+# and where the block starts and how many bytes it takes in the alert file
+INDEX_ENTRY = struct.Struct('<ddQQ')
+
+ACTIONS = ('alert', 'drop')
+EXTENSIONS = {'jsonl': '.jsonl', 'binary': '.bin'}
+
+def decode_record(record):
+    first_seen, last_seen, count, rule_id, src_port, dst_port, protocol, action, length, src_ip, dst_ip = record
+    return {
+        'timestamp': first_seen,
+        'last_seen': last_seen,
+        'count': count,
+        'rule_id': rule_id,
+        'action': ACTIONS[action],
+        'src_ip': address(src_ip[:length]),
+        'dst_ip': address(dst_ip[:length]),
+        'src_port': src_port,
+        'dst_port': dst_port,
+        'protocol': protocol
+    }
+
+def index_path(path):
+    return os.path.splitext(path)[0] + '.idx'
+
+class AlertLog:
+    # The packet thread packs alerts into a preallocated ring of fixed-size
+    # records; the control thread copies them out and appends them to the
+    # current alert file, rotated by size and age. Repeats of a rule on the same
+    # flow (or source) within aggregate_window are counted and written as one
+    # record when the window closes.
+    def __init__(self, config, queue_id):
+        alert_config = config.get('alerts', {})
+        self.format = alert_config.get('format', 'jsonl')
+        self.directory = alert_config.get('directory', '.')
+        self.prefix = f"alerts_q{queue_id}-"
+        self.rotate_bytes = alert_config.get('rotate_bytes', 64 * 1024 * 1024)
+        self.rotate_interval = alert_config.get('rotate_interval', 3600)
+        self.max_files = alert_config.get('max_files', 24)
+        self.index_every = alert_config.get('index_every', 256)
+        self.aggregate = alert_config.get('aggregate', 'flow')
+        self.aggregate_window = alert_config.get('aggregate_window', 10)
+        self.max_aggregates = alert_config.get('max_aggregates', 65536)
+        self.capacity = alert_config.get('buffer_size', 65536)
+        self.ring = bytearray(self.capacity * ALERT_RECORD.size)
+        # Records packed by the packet thread and records written out; each
+        # side only moves its own counter
+        self.head = 0
+        self.tail = 0
+        self.overflows = 0
+        self.suppressed = 0
+        self.recent = {}
+        self.file = None
+        self.index = None
+        self.opened = 0
+        self.opened_ms = 0
+        self.file_bytes = 0
+        self.block = None
+
+    def pending(self):
+        return self.head - self.tail
+
+    def push(self, first_seen, last_seen, count, fields):
+        if self.head - self.tail >= self.capacity:
+            self.overflows += 1
+            return
+        rule_id, action, src_ip, dst_ip, src_port, dst_port, protocol = fields
+        ALERT_RECORD.pack_into(
+            self.ring, (self.head % self.capacity) * ALERT_RECORD.size,
+            first_seen, last_seen, count, rule_id, src_port, dst_port, protocol, action, len(src_ip), src_ip, dst_ip
+        )
+        self.head += 1
+
+    def hit(self, now, rule_id, action, src_ip, dst_ip, src_port, dst_port, protocol):
+        # Packet thread
+        if self.format == 'none':
+            return
+        fields = (rule_id, int(action == 'drop'), src_ip, dst_ip, src_port, dst_port, protocol)
+        if self.aggregate == 'none':
+            self.push(now, now, 1, fields)
+            return
+
+        key = (rule_id, src_ip) if self.aggregate == 'source' else fields
+        entry = self.recent.get(key)
+        if entry is not None:
+            if not entry[1]:
+                entry[2] = now
+            entry[1] += 1
+            entry[3] = now
+            self.suppressed += 1
+            return
+
+        if len(self.recent) < self.max_aggregates:
+            # [window start, repeats, first repeat, last repeat, fields]
+            self.recent[key] = [now, 0, now, now, fields]
+        self.push(now, now, 1, fields)
+
+    def expire(self, now=None, everything=False):
+        # Packet thread. Entries are in the order their windows opened, so the
+        # scan stops at the first window still open
+        if now is None:
+            now = time.time()
+        recent = self.recent
+        while recent:
+            key = next(iter(recent))
+            opened, repeats, first_repeat, last_repeat, fields = recent[key]
+            if not everything and now - opened < self.aggregate_window:
+                break
+            del recent[key]
+            if repeats:
+                self.push(first_repeat, last_repeat, repeats, fields)
+
+    def flush(self, now=None):
+        # Control thread
+        if now is None:
+            now = time.time()
+        if self.format == 'none':
+            return
+        if self.file is not None and now - self.opened >= self.rotate_interval:
+            # The next file is only opened once there is something to write
+            self.close_file()
+
+        head = self.head
+        if head == self.tail:
+            return
+        if self.file is None:
+            self.open(now)
+
+        size = ALERT_RECORD.size
+        while self.tail < head:
+            start = self.tail % self.capacity
+            end = min(start + head - self.tail, self.capacity)
+            chunk = bytes(self.ring[start * size:end * size])
+            self.tail += end - start
+            for offset, record in enumerate(ALERT_RECORD.iter_unpack(chunk)):
+                if self.format == 'binary':
+                    data = chunk[offset * size:(offset + 1) * size]
+                else:
+                    data = (json.dumps(decode_record(record)) + '\n').encode()
+                self.write(data, record[0], record[1])
+                if self.file_bytes >= self.rotate_bytes:
+                    self.rotate(now)
+
+        if self.file is not None:
+            self.file.flush()
+            self.index.flush()
+
+    def write(self, data, first_seen, last_seen):
+        if self.block is None:
+            self.block = [first_seen, last_seen, self.file_bytes, 0, 0]
+        block = self.block
+        block[0] = min(block[0], first_seen)
+        block[1] = max(block[1], last_seen)
+        block[3] += len(data)
+        block[4] += 1
+        self.file.write(data)
+        self.file_bytes += len(data)
+        if block[4] >= self.index_every:
+            self.write_index()
+
+    def write_index(self):
+        if self.block is not None:
+            self.index.write(INDEX_ENTRY.pack(*self.block[:4]))
+            self.block = None
+
+    def open(self, now):
+        # Files are named after the millisecond they were opened in, bumped so
+        # a rotation within the same millisecond still gets a new file
+        self.opened_ms = max(int(now * 1000), self.opened_ms + 1)
+        name = f"{self.prefix}{self.opened_ms}{EXTENSIONS[self.format]}"
+        path = os.path.join(self.directory, name)
+        self.file = open(path, 'ab')
+        self.index = open(index_path(path), 'ab')
+        self.file_bytes = self.file.tell()
+        self.opened = now
+        self.prune()
+
+    def rotate(self, now):
+        self.close_file()
+        self.open(now)
+
+    def close_file(self):
+        if self.file is None:
+            return
+        self.write_index()
+        self.file.close()
+        self.index.close()
+        self.file = self.index = None
+
+    def prune(self):
+        # Oldest alert files past max_files are removed with their index
+        if not self.max_files:
+            return
+        extension = EXTENSIONS[self.format]
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.startswith(self.prefix) and name.endswith(extension))
+        for name in names[:-self.max_files]:
+            path = os.path.join(self.directory, name)
+            for stale in (path, index_path(path)):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+
+    def close(self):
+        self.expire(everything=True)
+        self.flush()
+        self.close_file()
+
+def read_index(path):
+    try:
+        with open(index_path(path), 'rb') as f:
+            data = f.read()
+    except OSError:
+        return []
+    return list(INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]))
+
+def read_alerts(path, since=None, until=None, rule_id=None):
+    # Only the blocks whose hits overlap [since, until] are read, plus whatever
+    # was written after the last index entry
+    binary = path.endswith(EXTENSIONS['binary'])
+    ranges = []
+    indexed = 0
+    for first_seen, last_seen, offset, length in read_index(path):
+        indexed = offset + length
+        if (since is None or last_seen >= since) and (until is None or first_seen <= until):
+            ranges.append((offset, length))
+    ranges.append((indexed, -1))
+
+    with open(path, 'rb') as f:
+        for offset, length in ranges:
+            f.seek(offset)
+            data = f.read(length)
+            if binary:
+                records = (decode_record(record) for record in
+                           ALERT_RECORD.iter_unpack(data[:len(data) - len(data) % ALERT_RECORD.size]))
+            else:
+                records = (json.loads(line) for line in data.splitlines() if line)
+            for alert in records:
+                if since is not None and alert['last_seen'] < since:
+                    continue
+                if until is not None and alert['timestamp'] > until:
+                    continue
+                if rule_id is not None and alert['rule_id'] != rule_id:
+                    continue
+                yield alert
+
+def main():
+    parser = argparse.ArgumentParser(description='Print the alerts in an alert file as JSON lines')
+    parser.add_argument('path', help='Alert file (.jsonl or .bin) written by a worker')
+    parser.add_argument('--since', type=float, help='Only alerts with hits at or after this UNIX time')
+    parser.add_argument('--until', type=float, help='Only alerts with hits at or before this UNIX time')
+    parser.add_argument('--rule', type=int, help='Only alerts for this rule id')
+    args = parser.parse_args()
+
+    for alert in read_alerts(args.path, args.since, args.until, args.rule):
+        sys.stdout.write(json.dumps(alert) + '\n')
+
+if __name__ == '__main__':
+    main()
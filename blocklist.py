@@ -0,0 +1,129 @@
+import math
+import time
+import ipaddress
+import subprocess
+from collections import deque
+from eventlog import address
+
+# Per-source entry: [tokens, last seen, rule hits, start of the hit window,
+# banned until, bans so far]
+TOKENS = 0
+LAST_SEEN = 1
+HITS = 2
+HITS_SINCE = 3
+BANNED_UNTIL = 4
+BANS = 5
+
+BANNED = "Source banned"
+RATE_LIMITED = "Source over rate limit"
+
+class SourceTable:
+    # Reputation of every source address the worker sees: a token bucket
+    # limiting its packet rate and a count of its drop rule hits. A source that
+    # hits drop rules ban_hits times within ban_window is banned, for twice as
+    # long as the last time on every ban after the first. Bans are queued for
+    # the control thread to add to the ipset the kernel drops sources from, so
+    # the worker stops seeing them at all; until then the worker drops them.
+    def __init__(self, config):
+        blocklist_config = config.get('blocklist', {})
+        self.rate = blocklist_config.get('rate', 0)
+        self.burst = blocklist_config.get('burst', 0)
+        if self.burst <= 0:
+            self.burst = self.rate
+        self.ban_hits = blocklist_config.get('ban_hits', 5)
+        self.ban_window = blocklist_config.get('ban_window', 60)
+        self.ban_time = blocklist_config.get('ban_time', 60)
+        self.max_ban_time = blocklist_config.get('max_ban_time', 3600)
+        self.source_timeout = blocklist_config.get('source_timeout', 600)
+        self.max_sources = blocklist_config.get('max_sources', 100000)
+        self.expire_slice = blocklist_config.get('expire_slice', 1024)
+        self.ipset = blocklist_config.get('ipset', 'ips_blocklist')
+        self.exempt = [ipaddress.ip_network(network) for network in blocklist_config.get('exempt', ['127.0.0.0/8', '::1/128'])]
+        # Exempt sources map to False
+        self.sources = {}
+        self.sweep = []
+        self.bans = deque()
+
+    def is_exempt(self, src_ip):
+        source = ipaddress.ip_address(src_ip)
+        return any(source in network for network in self.exempt)
+
+    def check(self, src_ip, now):
+        # Packet thread: None to go on inspecting the packet, or why to drop it.
+        # Once the table is full new sources are not tracked (or limited).
+        entry = self.sources.get(src_ip)
+        if entry is None:
+            if len(self.sources) >= self.max_sources:
+                return None
+            entry = False if self.is_exempt(src_ip) else [self.burst, now, 0, now, 0, 0]
+            self.sources[src_ip] = entry
+        if entry is False:
+            return None
+
+        if entry[BANNED_UNTIL] > now:
+            return BANNED
+        if self.rate:
+            tokens = min(self.burst, entry[TOKENS] + (now - entry[LAST_SEEN]) * self.rate)
+            entry[LAST_SEEN] = now
+            if tokens < 1:
+                entry[TOKENS] = tokens
+                return RATE_LIMITED
+            entry[TOKENS] = tokens - 1
+        else:
+            entry[LAST_SEEN] = now
+        return None
+
+    def hit(self, src_ip, now):
+        # Packet thread, on a drop rule match: the ban length in seconds if this
+        # hit got the source banned, else None
+        entry = self.sources.get(src_ip)
+        if not entry or not self.ban_hits:
+            return None
+        if now - entry[HITS_SINCE] > self.ban_window:
+            entry[HITS] = 0
+            entry[HITS_SINCE] = now
+        entry[HITS] += 1
+        if entry[HITS] < self.ban_hits:
+            return None
+
+        entry[HITS] = 0
+        entry[BANS] += 1
+        duration = min(self.ban_time * 2 ** (entry[BANS] - 1), self.max_ban_time)
+        entry[BANNED_UNTIL] = now + duration
+        self.bans.append((src_ip, duration))
+        return duration
+
+    def expire(self, now=None):
+        # Packet thread. Sources idle (and not banned) for source_timeout are
+        # forgotten, together with their ban history; each call checks the next
+        # expire_slice sources of a snapshot of the table
+        if now is None:
+            now = time.monotonic()
+        if not self.sweep:
+            self.sweep = list(self.sources)
+        for _ in range(min(self.expire_slice, len(self.sweep))):
+            src_ip = self.sweep.pop()
+            entry = self.sources.get(src_ip)
+            if entry is False or (entry and now - max(entry[LAST_SEEN], entry[BANNED_UNTIL]) > self.source_timeout):
+                del self.sources[src_ip]
+
+    def push_bans(self):
+        # Control thread: adds the queued bans to the kernel sets in one ipset
+        # call, with the ban length as the entry timeout. Returns the ipset
+        # error, if any.
+        lines = []
+        while self.bans:
+            src_ip, duration = self.bans.popleft()
+            name = self.ipset + '6' if len(src_ip) == 16 else self.ipset
+            lines.append(f"add {name} {address(src_ip)} timeout {math.ceil(duration)}\n")
+        if not lines or not self.ipset:
+            return None
+
+        try:
+            result = subprocess.run(['ipset', '-exist', 'restore'], input=''.join(lines),
+                                    capture_output=True, text=True, timeout=10)
+        except (OSError, subprocess.SubprocessError) as e:
+            return str(e)
+        if result.returncode != 0:
+            return result.stderr.strip()
+        return None
@@ -0,0 +1,108 @@
+import signal
+import threading
+import time
+import traceback
+from collections import deque
+
+class ControlPlane:
+    # Housekeeping of one worker on a thread of its own: ruleset reloads, flow
+    # expiry, stats snapshots and alert flushes. Anything that touches the flow
+    # table or the matcher is handed to the packet thread on a deque and run
+    # there between packets. An idle worker is woken with SIGUSR1, whose
+    # handler runs the queued work while the packet thread waits for packets.
+    def __init__(self, worker, interval=1.0, flush_interval=60):
+        self.worker = worker
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.tasks = deque()
+        # Set by the packet thread while it handles a packet or runs tasks
+        self.busy = False
+        self.packet_thread = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        # Called on the packet thread, which is the one signals are handled on
+        self.packet_thread = threading.get_ident()
+        signal.signal(signal.SIGUSR1, self.wake)
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+
+    def submit(self, function, *args):
+        self.tasks.append((function, args))
+        if not self.busy and self.packet_thread is not None:
+            signal.pthread_kill(self.packet_thread, signal.SIGUSR1)
+
+    def wake(self, signum, frame):
+        if not self.busy:
+            self.busy = True
+            try:
+                self.run_tasks()
+            finally:
+                self.busy = False
+
+    def run_tasks(self):
+        while self.tasks:
+            function, args = self.tasks.popleft()
+            try:
+                function(*args)
+            except Exception as e:
+                self.report(function, e)
+
+    def report(self, task, error):
+        name = getattr(task, '__name__', task)
+        self.worker.events.error(None, None, None, f"Control plane task {name} failed: {error!r}")
+        traceback.print_exc()
+
+    def loop(self):
+        # A failing step is reported and retried on the next tick; the thread
+        # itself must not die, or housekeeping and reloads stop for good
+        worker = self.worker
+        next_tick = time.monotonic()
+        next_flush = next_tick + self.flush_interval
+        while not self.stop_event.is_set():
+            # Waiting for a ruleset doubles as the timer; a new one is unpickled
+            # here and only swapped in on the packet thread
+            try:
+                ruleset = worker.receive_ruleset(max(0, next_tick - time.monotonic()))
+                if ruleset is not None:
+                    self.submit(worker.swap_ruleset, *ruleset)
+            except Exception as e:
+                self.report(worker.receive_ruleset, e)
+                self.stop_event.wait(self.interval)
+
+            now = time.monotonic()
+            if now < next_tick:
+                continue
+            next_tick = now + self.interval
+
+            self.tick(now >= next_flush)
+            if now >= next_flush:
+                next_flush = now + self.flush_interval
+
+    def tick(self, flush):
+        # Each step is reported on its own so one failing does not hold up the rest
+        worker = self.worker
+        steps = [
+            (self.submit, worker.expire_flows),
+            (self.submit, worker.alerts.expire)
+        ]
+        if worker.blocklist is not None:
+            steps.append((self.submit, worker.blocklist.expire))
+            steps.append((worker.push_bans,))
+        if worker.profiler is not None and worker.profiler.slow_rules:
+            steps.append((self.submit, worker.handle_slow_rules))
+        steps.append((worker.update_flow_stats,))
+        if flush:
+            steps.append((worker.flush_logs,))
+
+        for function, *args in steps:
+            try:
+                function(*args)
+            except Exception as e:
+                self.report(args[0] if args else function, e)
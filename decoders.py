@@ -0,0 +1,249 @@
+import re
+from urllib.parse import unquote_to_bytes
+
+# Inspection buffers a rule can target with `field:`; the decoders below emit
+# them for the client side of a connection to one of their configured ports
+FIELDS = (
+    'http.method',
+    'http.uri',
+    'http.raw_uri',
+    'http.request_line',
+    'http.headers',
+    'http.body',
+    'smtp.command'
+)
+
+HEADER_END = re.compile(rb'\r?\n\r?\n')
+METHOD = re.compile(rb'[A-Za-z-]+$')
+MAX_LINE = 1024
+
+def normalize_uri(uri):
+    # Percent-decoded, with backslashes as slashes and without ./, ../ or
+    # repeated slashes in the path, so encoded variants of a path match the
+    # same rule
+    if uri[:7].lower() == b'http://' or uri[:8].lower() == b'https://':
+        slash = uri.find(b'/', uri.find(b'//') + 2)
+        uri = uri[slash:] if slash >= 0 else b'/'
+
+    path, separator, query = uri.partition(b'?')
+    path = unquote_to_bytes(path).replace(b'\\', b'/')
+    segments = []
+    for segment in path.split(b'/'):
+        if segment == b'..':
+            if segments:
+                segments.pop()
+        elif segment and segment != b'.':
+            segments.append(segment)
+
+    normalized = b'/' + b'/'.join(segments)
+    if path.endswith(b'/') and segments:
+        normalized += b'/'
+    if separator:
+        normalized += b'?' + unquote_to_bytes(query)
+    return normalized
+
+class HttpRequestDecoder:
+    # HTTP/1.x client stream: request line and headers of every request on the
+    # connection, and the first body_depth bytes of each body with the chunked
+    # framing removed. Anything that does not parse as HTTP stops the decoder.
+    def __init__(self, max_header_bytes=8192, body_depth=4096):
+        self.max_header_bytes = max_header_bytes
+        self.body_depth = body_depth
+        self.pending = bytearray()
+        self.state = 'headers'
+        self.remaining = 0
+        self.body = bytearray()
+        self.body_done = False
+        self.failed = False
+
+    def feed(self, data):
+        fields = []
+        self.pending += data
+        while not self.failed:
+            if self.state == 'headers':
+                end = HEADER_END.search(self.pending)
+                if end is None:
+                    if len(self.pending) > self.max_header_bytes:
+                        self.failed = True
+                    break
+                head = bytes(self.pending[:end.start()])
+                del self.pending[:end.end()]
+                self.request(head, fields)
+
+            elif self.state == 'body' or self.state == 'chunk_data':
+                if not self.pending:
+                    break
+                take = min(self.remaining, len(self.pending))
+                self.collect(self.pending[:take], fields)
+                del self.pending[:take]
+                self.remaining -= take
+                if self.remaining:
+                    break
+                if self.state == 'body':
+                    self.end_body(fields)
+                else:
+                    self.state = 'chunk_end'
+
+            else:
+                # chunk_size, chunk_end and trailers are read line by line
+                end = self.pending.find(b'\n')
+                if end < 0:
+                    if len(self.pending) > MAX_LINE:
+                        self.failed = True
+                    break
+                line = bytes(self.pending[:end]).strip()
+                del self.pending[:end + 1]
+
+                if self.state == 'chunk_size':
+                    try:
+                        size = int(line.split(b';')[0], 16)
+                    except ValueError:
+                        self.failed = True
+                        break
+                    if size:
+                        self.remaining = size
+                        self.state = 'chunk_data'
+                    else:
+                        self.state = 'trailers'
+                elif self.state == 'chunk_end':
+                    self.state = 'chunk_size'
+                elif not line:
+                    self.end_body(fields)
+
+        return fields
+
+    def request(self, head, fields):
+        lines = head.split(b'\n')
+        parts = lines[0].strip().split(None, 2)
+        if len(parts) < 2 or not METHOD.match(parts[0]):
+            self.failed = True
+            return
+
+        method, target = parts[0], parts[1]
+        version = parts[2] if len(parts) > 2 else b''
+        uri = normalize_uri(target)
+        headers = [line.rstrip(b'\r') for line in lines[1:]]
+        fields.append(('http.method', method))
+        fields.append(('http.raw_uri', target))
+        fields.append(('http.uri', uri))
+        fields.append(('http.request_line', b' '.join((method, uri, version)).rstrip()))
+        if headers:
+            fields.append(('http.headers', b'\r\n'.join(headers)))
+
+        chunked = False
+        length = 0
+        for header in headers:
+            name, _, value = header.partition(b':')
+            name = name.strip().lower()
+            if name == b'transfer-encoding':
+                chunked = b'chunked' in value.lower()
+            elif name == b'content-length':
+                try:
+                    length = int(value)
+                except ValueError:
+                    self.failed = True
+                    return
+
+        if chunked:
+            self.state = 'chunk_size'
+        elif length > 0:
+            self.state = 'body'
+            self.remaining = length
+
+    def collect(self, data, fields):
+        if self.body_done:
+            return
+        self.body += data[:self.body_depth - len(self.body)]
+        if len(self.body) >= self.body_depth:
+            # Matched once it is full; the rest of the body is only skipped
+            fields.append(('http.body', bytes(self.body)))
+            self.body_done = True
+
+    def end_body(self, fields):
+        if self.body and not self.body_done:
+            fields.append(('http.body', bytes(self.body)))
+        self.body = bytearray()
+        self.body_done = False
+        self.state = 'headers'
+
+class SmtpClientDecoder:
+    # SMTP client stream: every command line. Message data after DATA (up to
+    # the final dot) and BDAT chunks are skipped; after STARTTLS the rest of
+    # the connection is encrypted and the decoder stops, without failing: the
+    # field rules have nothing left to match.
+    def __init__(self, max_line=MAX_LINE):
+        self.max_line = max_line
+        self.pending = bytearray()
+        self.state = 'command'
+        self.remaining = 0
+        self.failed = False
+        self.stopped = False
+
+    def feed(self, data):
+        fields = []
+        if self.stopped:
+            return fields
+        self.pending += data
+        while not self.failed:
+            if self.state == 'command':
+                end = self.pending.find(b'\n')
+                if end < 0:
+                    if len(self.pending) > self.max_line:
+                        self.failed = True
+                    break
+                line = bytes(self.pending[:end]).rstrip(b'\r')
+                del self.pending[:end + 1]
+                fields.append(('smtp.command', line))
+
+                verb = line[:8].upper()
+                if verb.startswith(b'DATA'):
+                    self.state = 'data'
+                    # The terminating CRLF.CRLF starts with the CRLF of the DATA line
+                    self.pending[0:0] = b'\r\n'
+                elif verb.startswith(b'BDAT '):
+                    try:
+                        self.remaining = int(line.split()[1])
+                    except (IndexError, ValueError):
+                        self.failed = True
+                        break
+                    self.state = 'bdat'
+                elif verb.startswith(b'STARTTLS'):
+                    self.stopped = True
+                    self.pending = bytearray()
+                    break
+
+            elif self.state == 'data':
+                end = self.pending.find(b'\r\n.\r\n')
+                if end < 0:
+                    del self.pending[:-4]
+                    break
+                del self.pending[:end + 5]
+                self.state = 'command'
+
+            else:
+                take = min(self.remaining, len(self.pending))
+                del self.pending[:take]
+                self.remaining -= take
+                if self.remaining:
+                    break
+                self.state = 'command'
+
+        return fields
+
+DECODERS = ('http', 'smtp')
+
+def decoder_ports(config):
+    # Server port -> decoder name, from the `decoders` section of the config
+    ports = {}
+    for name, port_list in config.get('decoders', {}).items():
+        if name not in DECODERS:
+            print(f"Unknown decoder {name!r}, ignored")
+            continue
+        for port in port_list:
+            ports[port] = name
+    return ports
+
+def new_decoder(name, config):
+    if name == 'http':
+        return HttpRequestDecoder(config.get('http_max_header_bytes', 8192), config.get('http_body_depth', 4096))
+    return SmtpClientDecoder()
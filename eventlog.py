@@ -0,0 +1,121 @@
+import json
+import socket
+import syslog
+import threading
+import time
+from collections import deque
+
+PRIORITIES = {
+    'ACCEPT': syslog.LOG_INFO,
+    'DROP': syslog.LOG_WARNING,
+    'ERROR': syslog.LOG_ERR
+}
+
+def address(value):
+    # The packet path hands over raw address bytes; they are only turned into
+    # text here, on the writer thread
+    if isinstance(value, bytes):
+        return socket.inet_ntop(socket.AF_INET6 if len(value) == 16 else socket.AF_INET, value)
+    return value
+
+class EventLogger:
+    # The packet path only appends a tuple to a bounded deque; a background
+    # thread formats and writes the records in batches.
+    def __init__(self, config, queue_id):
+        log_config = config.get('logging', {})
+        self.level = log_config.get('level', 'drops')
+        sample_rate = log_config.get('accept_sample_rate', 0)
+        self.accept_every = int(1 / sample_rate) if sample_rate > 0 else 0
+        self.accept_count = 0
+        self.sink = log_config.get('sink', 'syslog')
+        self.path = log_config.get('path', 'events_q{queue}.log').format(queue=queue_id)
+        self.batch_size = log_config.get('batch_size', 512)
+        self.flush_interval = log_config.get('flush_interval', 1.0)
+        self.events = deque(maxlen=log_config.get('buffer_size', 65536))
+        self.overflows = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.file = None
+
+    def start(self):
+        if self.sink != 'syslog':
+            self.file = open(self.path, 'a')
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    def push(self, record):
+        if len(self.events) == self.events.maxlen:
+            self.overflows += 1
+        self.events.append(record)
+
+    def accept(self, src_ip, dst_ip, protocol, reason):
+        if self.level == 'all':
+            self.push((time.time(), 'ACCEPT', src_ip, dst_ip, protocol, reason, None))
+        elif self.accept_every and self.level != 'none':
+            self.accept_count += 1
+            if self.accept_count % self.accept_every == 0:
+                self.push((time.time(), 'ACCEPT', src_ip, dst_ip, protocol, reason, None))
+
+    def drop(self, src_ip, dst_ip, protocol, reason, rules=None):
+        if self.level != 'none':
+            self.push((time.time(), 'DROP', src_ip, dst_ip, protocol, reason, rules))
+
+    def error(self, src_ip, dst_ip, protocol, reason):
+        self.push((time.time(), 'ERROR', src_ip, dst_ip, protocol, reason, None))
+
+    def format(self, record):
+        timestamp, verdict, src_ip, dst_ip, protocol, reason, rules = record
+        src_ip = address(src_ip)
+        dst_ip = address(dst_ip)
+        if self.sink == 'jsonl':
+            return json.dumps({
+                'timestamp': timestamp,
+                'verdict': verdict,
+                'src_ip': src_ip,
+                'dst_ip': dst_ip,
+                'protocol': protocol,
+                'reason': reason,
+                'rules': rules
+            })
+        if rules:
+            reason = f"{reason}: rules {', '.join(str(rule_id) for rule_id in rules)}"
+        return f"[{verdict}] {src_ip} -> {dst_ip}; proto: {protocol}; {reason}"
+
+    def write_batch(self):
+        batch = []
+        while self.events and len(batch) < self.batch_size:
+            batch.append(self.events.popleft())
+
+        if not batch:
+            return False
+
+        try:
+            if self.sink == 'syslog':
+                for record in batch:
+                    syslog.syslog(PRIORITIES[record[1]], self.format(record))
+            else:
+                self.file.write(''.join(self.format(record) + '\n' for record in batch))
+                self.file.flush()
+        except Exception:
+            pass
+        return True
+
+    def writer(self):
+        while not self.stop_event.wait(self.flush_interval):
+            while self.write_batch():
+                pass
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+        while self.write_batch():
+            pass
+        if self.file is not None:
+            self.file.close()
+
+    def get_stats(self):
+        return {
+            'pending_events': len(self.events),
+            'dropped_events': self.overflows
+        }
@@ -1,22 +1,31 @@
 #!/usr/bin/env python3
 
 import os
+import gc
 import sys
 import yaml
+import pickle
 import time
 import signal
 import multiprocessing as mp
-from matcher import MatcherEngine
-from worker import PacketWorker
+from matcher import MatcherEngine, compile_ruleset, dumps_ruleset
+from worker import PacketWorker, OFFLOAD_ORIGINAL, OFFLOAD_REPLY, OFFLOAD_DROP
 from metrics import MetricsServer
+from stats import HEARTBEAT, BUSY_SINCE, WORKER_RESTARTS
 
 class IDSIPSSystem:
     def __init__(self, config_file='config.yaml'):
+        self.config_file = config_file
         self.config = self.load_config(config_file)
         self.matcher = MatcherEngine()
         self.workers = []
+        self.reload_queues = []
+        self.ruleset_generation = mp.RawValue('Q', 0)
+        self.reload_requested = False
+        self.shared_stats = None
         self.metrics_server = None
         self.metrics_process = None
+        self.queue_baseline = None
         self.running = True
 
     def load_config(self, config_file):
@@ -31,19 +40,7 @@ class IDSIPSSystem:
         rules = self.config.get('rules', [])
         print(rules)
 
-        for rule in rules:
-            rule_id = rule['id']
-            pattern = rule['pattern']
-            protocol = rule.get('protocol', 'any')
-            action = rule.get('action', 'drop')
-            rule_type = rule['type']
-
-            if rule_type == 'literal':
-                self.matcher.add_literal_rule(rule_id, pattern, protocol, action)
-            elif rule_type == 'regex':
-                self.matcher.add_regex_rule(rule_id, pattern, protocol, action)
-
-        self.matcher.build()
+        self.matcher = compile_ruleset(rules, self.config.get('ruleset_cache'), self.config.get('matcher_backend', 'auto'))
         print(f"Built matcher with {len(rules)} rules")
 
     def start_metrics_server(self):
@@ -52,63 +49,175 @@ class IDSIPSSystem:
         self.metrics_process.start()
         print(f"Started metrics server on {self.config.get('http_metrics', {}).get('host', '127.0.0.1')}:{self.config.get('http_metrics', {}).get('port', 8080)}")
 
+    def netfilter_rules(self, blocklist_set=None):
+        # One rule per chain; --queue-balance hashes the address pair symmetrically,
+        # so both directions of a flow reach the same worker
+        queue_count = self.config.get('queues', 4)
+        if queue_count > 1:
+            target = f"NFQUEUE --queue-balance 0:{queue_count - 1}"
+            if self.config.get('queue_cpu_fanout', False):
+                target += " --queue-cpu-fanout"
+        else:
+            target = "NFQUEUE --queue-num 0"
+        if self.config.get('queue_bypass', True):
+            # Packets pass instead of being dropped while a queue has no worker
+            # bound, e.g. while a stuck worker is being restarted
+            target += " --queue-bypass"
+
+        rules = []
+        if blocklist_set:
+            # Sources the workers banned are dropped before they reach a queue
+            rules.append(('INPUT', f"-m set --match-set {blocklist_set} src -j DROP"))
+        for chain in ('INPUT', 'OUTPUT'):
+            if self.config.get('flow_offload', 'none') == 'connmark':
+                # Workers re-inject decided packets with a mark (see worker.offload);
+                # it is copied to the connection, which then bypasses the queue
+                for mark in (OFFLOAD_ORIGINAL, OFFLOAD_REPLY, OFFLOAD_DROP):
+                    rules.append((chain, f"-m mark --mark {mark:#x}/{mark:#x} -j CONNMARK --set-mark {mark:#x}/{mark:#x}"))
+                rules.append((chain, f"-m connmark --mark {OFFLOAD_DROP:#x}/{OFFLOAD_DROP:#x} -j DROP"))
+                rules.append((chain, f"-m connmark --mark {OFFLOAD_ORIGINAL:#x}/{OFFLOAD_ORIGINAL:#x} -m conntrack --ctdir ORIGINAL -j ACCEPT"))
+                rules.append((chain, f"-m connmark --mark {OFFLOAD_REPLY:#x}/{OFFLOAD_REPLY:#x} -m conntrack --ctdir REPLY -j ACCEPT"))
+            rules.append((chain, f"-j {target}"))
+        return rules
+
+    def netfilter_commands(self):
+        # The same rules queue IPv6 traffic when ipv6 is enabled
+        if self.config.get('ipv6', True):
+            return ('iptables', 'ip6tables')
+        return ('iptables',)
+
+    def blocklist_set(self, command):
+        # The ipset workers add banned sources to, one per address family
+        blocklist = self.config.get('blocklist', {})
+        name = blocklist.get('ipset', 'ips_blocklist')
+        if not blocklist.get('enabled', False) or not name:
+            return None
+        return name + '6' if command == 'ip6tables' else name
+
+    def install_netfilter_rules(self):
+        for command in self.netfilter_commands():
+            blocklist_set = self.blocklist_set(command)
+            if blocklist_set:
+                family = 'inet6' if command == 'ip6tables' else 'inet'
+                os.system(f"ipset create {blocklist_set} hash:ip family {family} timeout 0 -exist")
+            positions = {}
+            for chain, rule in self.netfilter_rules(blocklist_set):
+                positions[chain] = positions.get(chain, 0) + 1
+                os.system(f"{command} -I {chain} {positions[chain]} {rule}")
+
+    def remove_netfilter_rules(self):
+        for command in self.netfilter_commands():
+            blocklist_set = self.blocklist_set(command)
+            for chain, rule in self.netfilter_rules(blocklist_set):
+                os.system(f"{command} -D {chain} {rule}")
+            if blocklist_set:
+                os.system(f"ipset destroy {blocklist_set}")
+
+    def read_queue_counters(self):
+        # queue_number peer_portid queue_total copy_mode copy_range queue_dropped user_dropped id_sequence 1
+        counters = {}
+        try:
+            with open('/proc/net/netfilter/nfnetlink_queue') as f:
+                for line in f:
+                    fields = line.split()
+                    counters[int(fields[0])] = int(fields[7])
+        except (OSError, IndexError, ValueError):
+            return None
+        return counters
+
+    def check_queues(self):
+        counters = self.read_queue_counters()
+        if counters is None or self.queue_baseline is None:
+            return
+
+        for queue_id in range(self.config.get('queues', 4)):
+            if queue_id not in counters:
+                print(f"Warning: queue {queue_id} has no worker bound")
+            elif counters[queue_id] == self.queue_baseline.get(queue_id, 0):
+                print(f"Warning: queue {queue_id} received no packets in {self.config.get('queue_selfcheck', 10)}s")
+
+    def start_worker(self, queue_id):
+        # A restarted worker gets a fresh reload queue: the old one may have
+        # been left locked by the killed process. It is forked with the
+        # current matcher, so it needs nothing from the old queue either.
+        reload_queue = mp.Queue()
+        worker_process = mp.Process(
+            target=self.worker_main,
+            args=(queue_id, self.config, self.shared_stats, reload_queue)
+        )
+        worker_process.start()
+        print(f"Started worker for queue {queue_id} (PID: {worker_process.pid})")
+        return worker_process, reload_queue
+
     def start_workers(self):
         queue_count = self.config.get('queues', 4)
-        shared_stats = self.metrics_server.get_shared_stats() if self.metrics_server else None
+        self.shared_stats = self.metrics_server.get_shared_stats() if self.metrics_server else None
 
         for queue_id in range(queue_count):
-            worker_process = mp.Process(
-                target=self.worker_main,
-                args=(queue_id, self.config, shared_stats)
-            )
-            worker_process.start()
+            worker_process, reload_queue = self.start_worker(queue_id)
             self.workers.append(worker_process)
-            os.system(f"iptables -I INPUT -j NFQUEUE --queue-num {queue_id}")
-            os.system(f"iptables -I OUTPUT -j NFQUEUE --queue-num {queue_id}")
-            print(f"Started worker for queue {queue_id} (PID: {worker_process.pid})")
-
-    def worker_main(self, queue_id, config, shared_stats):
-        matcher = MatcherEngine()
-        rules = config.get('rules', [])
-
-        for rule in rules:
-            rule_id = rule['id']
-            pattern = rule['pattern']
-            protocol = rule.get('protocol', 'any')
-            action = rule.get('action', 'drop')
-            rule_type = rule['type']
-
-            if rule_type == 'literal':
-                matcher.add_literal_rule(rule_id, pattern, protocol, action)
-            elif rule_type == 'regex':
-                matcher.add_regex_rule(rule_id, pattern, protocol, action)
-
-        matcher.build()
-
-        worker = PacketWorker(queue_id, matcher, config)
-
-        def update_stats():
-            if shared_stats is not None:
-                shared_stats[queue_id] = worker.get_stats()
-
-        last_stats_update = time.time()
-
-        def stats_updater():
-            nonlocal last_stats_update
-            current_time = time.time()
-            if current_time - last_stats_update > 5:
-                update_stats()
-                last_stats_update = current_time
-
-        original_callback = worker.packet_callback
-        def enhanced_callback(packet):
-            result = original_callback(packet)
-            stats_updater()
-            return result
-
-        worker.packet_callback = enhanced_callback
+            self.reload_queues.append(reload_queue)
+
+        if queue_count > 1 and self.config.get('queue_cpu_fanout', False):
+            print("Warning: --queue-cpu-fanout selects the queue by CPU; both directions of a flow only share a worker if RSS/RPS steers them to the same CPU")
+
+        self.install_netfilter_rules()
+        self.queue_baseline = self.read_queue_counters()
+
+    def supervise_workers(self):
+        # A worker busy with one packet for longer than worker_stall_timeout is
+        # killed; dead workers are restarted and bind their queue again
+        stall_timeout = self.config.get('worker_stall_timeout', 5) * 1e9
+        now = time.monotonic_ns()
+        for queue_id, worker in enumerate(self.workers):
+            stats = self.shared_stats.worker(queue_id) if self.shared_stats is not None else None
+            if worker.is_alive():
+                if stats is None or not stats[BUSY_SINCE] or now - stats[BUSY_SINCE] < stall_timeout:
+                    continue
+                print(f"Worker for queue {queue_id} is stuck on one packet for {(now - stats[BUSY_SINCE]) / 1e9:.1f}s, restarting it")
+                worker.kill()
+                worker.join(timeout=5)
+            else:
+                print(f"Worker for queue {queue_id} died (exit code {worker.exitcode}), restarting it")
+
+            if stats is not None:
+                stats[BUSY_SINCE] = 0
+                stats[HEARTBEAT] = now
+                stats[WORKER_RESTARTS] += 1
+            self.workers[queue_id], self.reload_queues[queue_id] = self.start_worker(queue_id)
+
+    def worker_main(self, queue_id, config, shared_stats, reload_queue):
+        # Workers are forked after build_matcher, so they start with the
+        # parent's compiled matcher instead of building their own
+        stats = shared_stats.worker(queue_id) if shared_stats is not None else None
+        worker = PacketWorker(queue_id, self.matcher, config, stats, reload_queue, self.ruleset_generation)
         worker.run()
 
+    def reload_handler(self, signum, frame):
+        self.reload_requested = True
+
+    def reload_rules(self):
+        # Compile once here and hand the pickled matcher to every worker; each
+        # swaps it in before its next packet and keeps its flow table
+        self.reload_requested = False
+        try:
+            with open(self.config_file, 'r') as f:
+                rules = yaml.safe_load(f).get('rules', [])
+            matcher = compile_ruleset(rules, self.config.get('ruleset_cache'), self.config.get('matcher_backend', 'auto'))
+            ruleset = dumps_ruleset(matcher)
+            # Every worker unpickles this; one that cannot would stop reloading
+            pickle.loads(ruleset)
+        except Exception as e:
+            print(f"Rule reload failed, keeping the current rules: {e}")
+            return
+
+        generation = self.ruleset_generation.value + 1
+        for reload_queue in self.reload_queues:
+            reload_queue.put((generation, ruleset))
+        self.ruleset_generation.value = generation
+        self.matcher = matcher
+        print(f"Reloaded {len(rules)} rules (generation {generation})")
+
     def signal_handler(self, signum, frame):
         print(f"\nReceived signal {signum}, shutting down...")
         self.running = False
@@ -146,8 +255,13 @@ class IDSIPSSystem:
 
         signal.signal(signal.SIGINT, self.signal_handler)
         signal.signal(signal.SIGTERM, self.signal_handler)
+        signal.signal(signal.SIGHUP, self.reload_handler)
 
         self.build_matcher()
+        # Everything built so far is shared copy-on-write with the forked
+        # processes; keeping it out of the GC stops collections from touching
+        # (and so copying) those pages
+        gc.freeze()
         self.start_metrics_server()
 
         time.sleep(1)
@@ -157,20 +271,26 @@ class IDSIPSSystem:
         print(f"System started with {len(self.workers)} workers")
         print("Press Ctrl+C to stop")
 
+        selfcheck_at = time.time() + self.config.get('queue_selfcheck', 10)
+
         try:
             while self.running:
                 time.sleep(1)
 
-                alive_workers = [w for w in self.workers if w.is_alive()]
-                if len(alive_workers) != len(self.workers):
-                    print(f"Warning: {len(self.workers) - len(alive_workers)} workers died")
+                if self.reload_requested:
+                    self.reload_rules()
+
+                if selfcheck_at and time.time() >= selfcheck_at:
+                    self.check_queues()
+                    selfcheck_at = None
+
+                if self.running:
+                    self.supervise_workers()
 
         except KeyboardInterrupt:
             pass
         finally:
-            for i in range(self.config.get("queues", 4)):
-                os.system(f"iptables -D INPUT -j NFQUEUE --queue-num {i}")
-                os.system(f"iptables -D OUTPUT -j NFQUEUE --queue-num {i}")
+            self.remove_netfilter_rules()
             self.shutdown()
 
 def main():
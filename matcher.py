@@ -1,53 +1,885 @@
+import os
 import re
+import sys
+import time
+import json
+import mmap
+import pickle
+import hashlib
+import io
+from bisect import bisect_right
 import ahocorasick
+from decoders import FIELDS
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+MIN_ATOM_LENGTH = 2
+# Bump when the layout of a built MatcherEngine changes so old cache files are ignored
+CACHE_VERSION = 7
+PROTOCOLS = ('tcp', 'udp', 'any')
+DIRECTIONS = ('any', 'to_server', 'to_client')
+# The raw stream of a flow whose decoder is working: its field rules run on
+# the decoded buffers instead. Any other raw stream (field=None) is matched
+# against every rule, field rules included.
+DECODED_STREAM = 'stream'
+
+def fold(data):
+    # ASCII-only case folding, the same folding re.IGNORECASE applies to bytes
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    data = data.lower()
+    return data.decode('latin-1') if ahocorasick.unicode else data
+
+def parse_ports(ports):
+    # ports: a port, a "low-high" range or a list of either
+    if ports is None:
+        return frozenset()
+    if not isinstance(ports, list):
+        ports = [ports]
+
+    result = set()
+    for entry in ports:
+        if isinstance(entry, str) and '-' in entry:
+            low, high = entry.split('-', 1)
+            result.update(range(int(low), int(high) + 1))
+        else:
+            result.add(int(entry))
+    return frozenset(result)
+
+def extract_atoms(parsed):
+    # Literal runs that every match of the regex must contain, plus whether
+    # the regex is nothing but one literal (then an automaton hit is a match)
+    atoms = []
+    current = []
+    exact = True
+
+    for op, av in parsed:
+        if op is sre_parse.LITERAL:
+            current.append(av)
+            continue
+
+        exact = False
+        if op is sre_parse.MAX_REPEAT or op is sre_parse.MIN_REPEAT:
+            low, high, item = av
+            if low > 0 and all(item_op is sre_parse.LITERAL for item_op, _ in item):
+                current.extend([item_av for _, item_av in item] * low)
+                if low == high:
+                    continue
+
+        atoms.append(bytes(current))
+        current = []
+
+    atoms.append(bytes(current))
+    return [atom for atom in atoms if atom], exact and len(parsed) > 0
+
+def is_any_repeat(item):
+    op, av = item
+    return (op is sre_parse.MAX_REPEAT and av[0] == 0 and av[1] == sre_parse.MAXREPEAT
+            and list(av[2]) == [(sre_parse.ANY, None)])
+
+def strip_wildcards(pattern, parsed):
+    # A leading or trailing greedy .* never decides whether a regex matches, it
+    # only stretches the match to the line ends; without the leading one re no
+    # longer rescans to the end of the line from every start position
+    if len(parsed) > 1 and is_any_repeat(parsed[0]) and pattern.startswith(b'.*') and not pattern.startswith(b'.*?'):
+        pattern = pattern[2:]
+    if len(parsed) > 1 and is_any_repeat(parsed[-1]) and pattern.endswith(b'.*'):
+        pattern = pattern[:-2]
+    return pattern
+
+def backtracking_risk(parsed):
+    # The first construct that can make a backtracking engine take more than
+    # linear time in the input length, or None
+    for op, av in parsed:
+        if op is sre_parse.GROUPREF or op is sre_parse.GROUPREF_EXISTS:
+            return 'backreference'
+        if op is sre_parse.ASSERT or op is sre_parse.ASSERT_NOT:
+            return 'lookaround'
+        if op is sre_parse.MAX_REPEAT or op is sre_parse.MIN_REPEAT:
+            low, high, item = av
+            if high == sre_parse.MAXREPEAT and not all(item_op is sre_parse.LITERAL for item_op, _ in item):
+                return 'unbounded repeat'
+            risk = backtracking_risk(item)
+        elif op is sre_parse.SUBPATTERN:
+            risk = backtracking_risk(av[-1])
+        elif op is sre_parse.BRANCH:
+            risk = next((risk for risk in map(backtracking_risk, av[1]) if risk), None)
+        else:
+            risk = None
+        if risk:
+            return risk
+    return None
+
+class ReBackend:
+    # Python's backtracking engine; runs every valid rule but gives no bound
+    # on the time per byte
+    name = 're'
+    linear = False
+    errors = (re.error,)
+    pattern_type = re.Pattern
+    # Rules per shared database, for backends that compile sets of patterns
+    # much faster than one at a time; 0 compiles every rule on its own
+    set_size = 0
+
+    def compile(self, pattern):
+        return re.compile(pattern, re.IGNORECASE)
+
+    def mergeable(self, rule):
+        # Rules without capture groups or inline flags can share one alternation
+        return rule['compiled'].groups == 0 and not rule['search'].startswith(b'(?')
+
+    def compile_set(self, patterns):
+        # Each pattern is wrapped in a named group so hits map back to the rule
+        return self.compile(b'|'.join(b'(?P<r%d>%s)' % (index, pattern) for index, pattern in enumerate(patterns)))
+
+    def source(self, compiled):
+        return compiled.pattern
+
+    def reduce(self, compiled):
+        # How a compiled pattern is saved in a cached ruleset
+        return LazyPattern, (self.name, self.source(compiled))
+
+class Re2Backend(ReBackend):
+    # RE2 automata: linear in the input, no backreferences or lookaround
+    name = 're2'
+    linear = True
 
-class MatcherEngine:
     def __init__(self):
-        self.ac_automaton = ahocorasick.Automaton()
+        self.options = re2.Options()
+        self.options.case_sensitive = False
+        self.options.encoding = re2.Options.Encoding.LATIN1
+        self.options.log_errors = False
+        self.errors = (re2.error,)
+        self.pattern_type = type(re2.compile(b'', self.options))
+
+    def compile(self, pattern):
+        return re2.compile(pattern, self.options)
+
+class HyperscanMatch:
+    __slots__ = ('data', 'start', 'stop', 'lastgroup')
+
+    def __init__(self, data, start, stop, lastgroup):
+        self.data = data
+        self.start = start
+        self.stop = stop
+        self.lastgroup = lastgroup
+
+    def group(self):
+        return self.data[self.start:self.stop]
+
+    def end(self):
+        return self.stop
+
+class HyperscanPattern:
+    # finditer()-style access to a block mode database. Every end offset of
+    # every pattern is reported rather than re's non-overlapping matches, which
+    # is all the matcher needs: that a rule hit and where the hit ends.
+    groups = 0
+
+    def __init__(self, patterns, serialized=None):
+        self.patterns = patterns
+        if serialized is not None:
+            self.database = hyperscan.loadb(serialized, hyperscan.HS_MODE_BLOCK)
+            self.database.scratch = hyperscan.Scratch(self.database)
+            return
+        self.database = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+        # Expressions are passed on as C strings, so a NUL has to be escaped
+        self.database.compile(
+            expressions=[pattern.replace(b'\x00', b'\\x00') for pattern in patterns],
+            ids=list(range(len(patterns))), elements=len(patterns),
+            flags=[hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SOM_LEFTMOST] * len(patterns)
+        )
+
+    def finditer(self, data, pos=0):
+        view = memoryview(data)
+        found = []
+
+        def on_match(index, start, end, flags, context):
+            found.append(HyperscanMatch(view, pos + start, pos + end, 'r%d' % index))
+
+        self.database.scan(view[pos:] if pos else view, match_event_handler=on_match)
+        return found
+
+class HyperscanBackend(ReBackend):
+    # Hyperscan automata: linear in the input, no backreferences or lookaround,
+    # and one database can scan for many patterns at once
+    name = 'hyperscan'
+    linear = True
+    pattern_type = HyperscanPattern
+    set_size = 64
+
+    def __init__(self):
+        self.errors = (hyperscan.error,)
+
+    def compile(self, pattern):
+        return HyperscanPattern([pattern])
+
+    def mergeable(self, rule):
+        return True
+
+    def compile_set(self, patterns):
+        return HyperscanPattern(patterns)
+
+    def source(self, compiled):
+        return compiled.patterns
+
+    def reduce(self, compiled):
+        # The database itself is saved, so a cached ruleset loads without
+        # compiling its sets again
+        return load_hyperscan, (compiled.patterns, hyperscan.dumpb(compiled.database))
+
+def load_hyperscan(patterns, serialized):
+    # A database saved by another Hyperscan version is compiled again
+    try:
+        return HyperscanPattern(patterns, serialized)
+    except hyperscan.error:
+        return HyperscanPattern(patterns)
+
+BACKENDS = {'re': ReBackend()}
+if re2 is not None:
+    BACKENDS['re2'] = Re2Backend()
+if hyperscan is not None:
+    BACKENDS['hyperscan'] = HyperscanBackend()
+
+def set_order(rule):
+    # Rules that always land in the same groups end up in the same sets
+    return rule['protocol'], rule['field'] or '', rule['direction'], sorted(rule['ports'])
+
+def select_backends(name):
+    # Backends to try for each rule, most preferred first; re runs anything the
+    # others reject
+    if name == 'auto':
+        names = [backend for backend in ('hyperscan', 're2') if backend in BACKENDS]
+    elif name in BACKENDS:
+        names = [name]
+    else:
+        print(f"Matcher backend {name} is not available, using re")
+        names = []
+    return [backend for backend in names if backend != 're'] + ['re']
+
+class LazyPattern:
+    # Stands in for a compiled pattern in a cached ruleset. It is compiled on
+    # first use and then replaces itself in the dict that holds it, so most
+    # signatures (literals confirmed by the automaton) are never compiled at all.
+    __slots__ = ('backend', 'source', 'holder', 'key')
+
+    def __init__(self, backend, source):
+        self.backend = backend
+        self.source = source
+        self.holder = None
+        self.key = None
+
+    def bind(self, holder, key):
+        self.holder = holder
+        self.key = key
+
+    def __reduce__(self):
+        # A cached ruleset passed on uncompiled (a reload of unchanged rules)
+        return LazyPattern, (self.backend, self.source)
+
+    def __getattr__(self, name):
+        # Only reached for attributes LazyPattern does not have; unset slots and
+        # dunder lookups (pickle, copy) must not trigger a compile
+        if name in LazyPattern.__slots__ or name.startswith('__'):
+            raise AttributeError(name)
+        backend = BACKENDS[self.backend]
+        if isinstance(self.source, list):
+            compiled = backend.compile_set(self.source)
+        else:
+            compiled = backend.compile(self.source)
+        if self.holder is not None:
+            self.holder[self.key] = compiled
+        return getattr(compiled, name)
+
+class RulesetPickler(pickle.Pickler):
+    def reducer_override(self, obj):
+        for name, backend in BACKENDS.items():
+            if isinstance(obj, backend.pattern_type):
+                return backend.reduce(obj)
+        return NotImplemented
+
+class MatcherEngine:
+    def __init__(self, backend='auto'):
+        self.backends = select_backends(backend)
         self.regex_rules = []
-        self.literal_rules = {}
+        self.compiled_rules = []
+        self.groups = {}
+        self.indexed_ports = {}
+        self.pattern_sets = []
+        # Decoder fields at least one rule targets
+        self.fields = frozenset()
         self.built = False
+        # Set by a worker to time rules on sampled scans (see profiler.py)
+        self.profiler = None
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for rule in self.regex_rules:
+            if isinstance(rule.get('compiled'), LazyPattern):
+                rule['compiled'].bind(rule, 'compiled')
+        for group in self.groups.values():
+            if isinstance(group['merged'], LazyPattern):
+                group['merged'].bind(group, 'merged')
+        for pattern_set in self.pattern_sets:
+            if isinstance(pattern_set['compiled'], LazyPattern):
+                pattern_set['compiled'].bind(pattern_set, 'compiled')
 
-    def add_literal_rule(self, rule_id, pattern, protocol, action):
-        self.ac_automaton.add_word(str(rule_id), pattern) #self.ac_automaton.add_word(pattern.encode(), rule_id)
-        self.literal_rules[rule_id] = {
-            'pattern': pattern,
+    def add_literal_rule(self, rule_id, pattern, protocol, action, ports=None, direction='any', depth=None, field=None):
+        pattern = pattern if isinstance(pattern, bytes) else pattern.encode()
+        self.regex_rules.append({
+            'id': rule_id,
+            'regex': re.escape(pattern),
             'protocol': protocol,
             'action': action,
-            'type': 'literal'
-        }
+            'type': 'literal',
+            'ports': parse_ports(ports),
+            'direction': direction,
+            'depth': depth,
+            'field': field
+        })
 
-    def add_regex_rule(self, rule_id, pattern, protocol, action):
+    def add_regex_rule(self, rule_id, pattern, protocol, action, ports=None, direction='any', depth=None, field=None):
         self.regex_rules.append({
             'id': rule_id,
             'regex': pattern if isinstance(pattern, bytes) else pattern.encode(),
             'protocol': protocol,
             'action': action,
-            'type': 'regex'
+            'type': 'regex',
+            'ports': parse_ports(ports),
+            'direction': direction,
+            'depth': depth,
+            'field': field
         })
 
+    def add_rules(self, rules):
+        for rule in rules:
+            rule_id = rule['id']
+            pattern = rule['pattern']
+            protocol = rule.get('protocol', 'any')
+            action = rule.get('action', 'drop')
+            rule_type = rule['type']
+            # Optional constraints: service ports, which side of the connection
+            # sends the match (to_server: towards ports) and how far into the
+            # flow (or datagram) it may end. field limits the rule to one buffer
+            # extracted by a protocol decoder instead of the raw stream.
+            ports = rule.get('ports')
+            direction = rule.get('direction', 'any')
+            depth = rule.get('depth')
+            field = rule.get('field')
+
+            # Alert records store the rule id as an unsigned 32-bit integer
+            if not isinstance(rule_id, int) or not 0 <= rule_id < 2 ** 32:
+                print(f"Skipping rule {rule_id!r}: rule ids must be integers from 0 to {2 ** 32 - 1}")
+                continue
+            if direction not in DIRECTIONS:
+                print(f"Skipping rule {rule_id}: unknown direction {direction!r}")
+                continue
+            if field is not None and field not in FIELDS:
+                print(f"Skipping rule {rule_id}: unknown field {field!r}")
+                continue
+
+            if rule_type == 'literal':
+                self.add_literal_rule(rule_id, pattern, protocol, action, ports, direction, depth, field)
+            elif rule_type == 'regex':
+                self.add_regex_rule(rule_id, pattern, protocol, action, ports, direction, depth, field)
+
+    def compile_rule(self, rule, backends=None):
+        try:
+            parsed = sre_parse.parse(rule['regex'], re.IGNORECASE)
+        except re.error as e:
+            print(f"Skipping rule {rule['id']}: invalid regex {rule['regex']!r} ({e})")
+            return False
+
+        rule['search'] = strip_wildcards(rule['regex'], parsed)
+        if rule['search'] != rule['regex']:
+            parsed = sre_parse.parse(rule['search'], re.IGNORECASE)
+
+        rule['set'] = None
+        for name in self.backends if backends is None else backends:
+            backend = BACKENDS[name]
+            if backend.set_size:
+                # Checked when its set is compiled (see compile_sets); the rule
+                # only gets a database of its own if it is ever scanned alone
+                rule['compiled'] = LazyPattern(name, rule['search'])
+                rule['compiled'].bind(rule, 'compiled')
+                rule['backend'] = name
+                break
+            try:
+                rule['compiled'] = backend.compile(rule['search'])
+            except backend.errors:
+                continue
+            rule['backend'] = name
+            break
+        else:
+            print(f"Skipping rule {rule['id']}: no matcher backend can compile {rule['regex']!r}")
+            return False
+
+        atoms, exact = extract_atoms(parsed)
+        rule['width'] = parsed.getwidth()[1]
+        rule['risk'] = None if BACKENDS[rule['backend']].linear else backtracking_risk(parsed)
+        atoms = [atom for atom in atoms if len(atom) >= MIN_ATOM_LENGTH]
+        rule['atoms'] = list(dict.fromkeys(fold(atom) for atom in atoms))
+        rule['exact'] = exact and len(atoms) == 1
+        rule['literal'] = atoms[0] if rule['exact'] else None
+        return True
+
+    def compile_alternation(self, rules):
+        # Ungated rules on the preferred backend are scanned for in one pass
+        backend = BACKENDS[self.backends[0]]
+        mergeable = []
+        standalone = []
+        for rule in rules:
+            if rule['backend'] == backend.name and backend.mergeable(rule):
+                mergeable.append(rule)
+            else:
+                standalone.append(rule)
+
+        merged = None
+        if mergeable:
+            try:
+                merged = backend.compile_set([rule['search'] for rule in mergeable])
+            except backend.errors:
+                standalone = rules
+                mergeable = []
+
+        return merged, mergeable, standalone
+
+    def compile_sets(self):
+        # Rules on a backend with a set_size share one database per set_size of
+        # them, and a candidate rule is confirmed by scanning its set; the
+        # database maps hits back to the rules. A set the backend rejects is
+        # compiled again without the rules it rejects on their own, which go
+        # on to the next backend.
+        self.pattern_sets = []
+        for position, name in enumerate(self.backends):
+            backend = BACKENDS[name]
+            if not backend.set_size:
+                continue
+            # Exact literals are confirmed by the automaton alone and need no check
+            rules = sorted((rule for rule in self.compiled_rules if rule['backend'] == name and not rule['exact']),
+                           key=set_order)
+            for offset in range(0, len(rules), backend.set_size):
+                chunk = rules[offset:offset + backend.set_size]
+                try:
+                    compiled = backend.compile_set([rule['search'] for rule in chunk])
+                except backend.errors:
+                    accepted = []
+                    for rule in chunk:
+                        try:
+                            rule['compiled'] = backend.compile(rule['search'])
+                            accepted.append(rule)
+                        except backend.errors:
+                            if not self.compile_rule(rule, self.backends[position + 1:]):
+                                self.compiled_rules.remove(rule)
+                    chunk = accepted
+                    if not chunk:
+                        continue
+                    compiled = backend.compile_set([rule['search'] for rule in chunk])
+
+                pattern_set = {'compiled': compiled, 'rules': chunk}
+                self.pattern_sets.append(pattern_set)
+                for rule in chunk:
+                    rule['set'] = pattern_set
+
+    def linear_report(self):
+        # Rules left to the backtracking engine whose run time can grow faster
+        # than the input
+        return [(rule['id'], rule['risk']) for rule in self.compiled_rules if rule['risk']]
+
+    def compile_group(self, rules):
+        gated = [rule for rule in rules if rule['atoms']]
+        ungated = [rule for rule in rules if not rule['atoms']]
+
+        automaton = None
+        if gated:
+            by_atom = {}
+            for rule in gated:
+                for index, atom in enumerate(rule['atoms']):
+                    by_atom.setdefault(atom, []).append((rule, index))
+
+            automaton = ahocorasick.Automaton()
+            for atom, atom_rules in by_atom.items():
+                automaton.add_word(atom, (len(atom), atom_rules))
+            automaton.make_automaton()
+
+        merged, merged_rules, standalone = self.compile_alternation(ungated)
+        return {
+            'automaton': automaton,
+            'width': max((rule['width'] for rule in merged_rules), default=0),
+            'merged': merged,
+            'merged_rules': merged_rules,
+            'standalone': standalone
+        }
+
+    def select_rules(self, protocol, dst_port, src_port, field=None):
+        selected = []
+        for rule in self.compiled_rules:
+            if field == DECODED_STREAM:
+                if rule['field'] is not None:
+                    continue
+            elif field is not None and rule['field'] != field:
+                continue
+            if rule['protocol'] != 'any' and rule['protocol'] != protocol:
+                continue
+            ports = rule['ports']
+            if ports:
+                if rule['direction'] == 'to_server':
+                    if dst_port not in ports:
+                        continue
+                elif rule['direction'] == 'to_client':
+                    if src_port not in ports:
+                        continue
+                elif dst_port not in ports and src_port not in ports:
+                    continue
+            selected.append(rule)
+        return selected
+
     def build(self):
-        self.ac_automaton.make_automaton()
+        # Groups are keyed by (protocol, destination port, source port, field),
+        # where a port no rule mentions is 0 and field is None for the raw
+        # stream (see DECODED_STREAM); a packet only sees the rules of its group. Groups for traffic
+        # between two indexed ports and field groups are built on first use.
+        self.compiled_rules = [rule for rule in self.regex_rules if self.compile_rule(rule)]
+        self.compile_sets()
+        self.fields = frozenset(rule['field'] for rule in self.compiled_rules if rule['field'])
+        self.groups = {}
+        for protocol in PROTOCOLS:
+            ports = set()
+            for rule in self.compiled_rules:
+                if rule['protocol'] == 'any' or rule['protocol'] == protocol:
+                    ports.update(rule['ports'])
+            self.indexed_ports[protocol] = frozenset(ports)
+
+            for key in [(protocol, 0, 0, None)] + [(protocol, port, 0, None) for port in ports] + [(protocol, 0, port, None) for port in ports]:
+                self.groups[key] = self.compile_group(self.select_rules(*key))
+
+        report = self.linear_report()
+        if report:
+            print("Rules that may not run in linear time: " + ", ".join(f"{rule_id} ({risk})" for rule_id, risk in report))
         self.built = True
 
-    def match(self, data, protocol):
+    def get_group(self, protocol, src_port=0, dst_port=0, field=None):
+        ports = self.indexed_ports.get(protocol)
+        if ports is None:
+            protocol = 'any'
+            ports = self.indexed_ports['any']
+
+        key = (protocol, dst_port if dst_port in ports else 0, src_port if src_port in ports else 0, field)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = self.compile_group(self.select_rules(*key))
+        return group
+
+    def disable_rule(self, rule_id):
+        # Takes a rule out of matching; the groups are rebuilt without it, so
+        # stream states built on the old groups have to be reset
+        self.compiled_rules = [rule for rule in self.compiled_rules if rule['id'] != rule_id]
+        self.fields = frozenset(rule['field'] for rule in self.compiled_rules if rule['field'])
+        self.groups = {key: self.compile_group(self.select_rules(*key)) for key in self.groups}
+
+    def window_size(self, max_window=8192):
+        # The longest match a stream scan can need, which is how much of a flow
+        # has to be kept around between segments
+        return max((min(rule['width'], max_window) for rule in self.regex_rules if 'width' in rule), default=0)
+
+    def new_stream(self):
+        # running is the rule (or group, for its merged pattern) being evaluated
+        # and skip holds the ids of those that ran out of time on this stream
+        return {'iter': None, 'scanned': 0, 'hits': {}, 'armed': {}, 'running': None, 'skip': set()}
+
+    def stream_hits(self, state):
+        return [{"rule_id": rule['id'], "matches": found, "action": rule['action']} for rule, found in state['hits'].values()]
+
+    def skip_running(self, state):
+        # Called when a scan of the stream was interrupted; the rule it was stuck
+        # in is left out of this stream's later scans
+        if state['running'] is not None:
+            state['skip'].add(id(state['running']))
+            state['running'] = None
+
+    def record_hit(self, hits, rule, found):
+        hits.setdefault(id(rule), (rule, set()))[1].add(bytes(found))
+
+    def record_hit_within(self, hits, rule, found, base):
+        # base turns a buffer offset into a stream offset for the depth check
+        if rule['depth'] is None or found.end() + base <= rule['depth']:
+            self.record_hit(hits, rule, found.group())
+
+    def scan_window(self, compiled, buffer, start, width, max_window):
+        # Re-scan just enough of the already inspected bytes to catch a match
+        # that ends inside the new data
+        window_start = max(0, start - max(min(width, max_window) - 1, 0))
+        for found in compiled.finditer(buffer, window_start):
+            if found.end() > start:
+                yield found
+
+    def confirm(self, hits, rule, buffer, start, base, max_window, profiler=None):
+        if profiler is None:
+            for found in self.scan_window(rule['compiled'], buffer, start, rule['width'], max_window):
+                self.record_hit_within(hits, rule, found, base)
+            return
+
+        if isinstance(rule['compiled'], LazyPattern):
+            # Compile a cached pattern outside the timed scan
+            rule['compiled'].groups
+        scanned = len(buffer) - max(0, start - max(min(rule['width'], max_window) - 1, 0))
+        started = time.perf_counter_ns()
+        for found in self.scan_window(rule['compiled'], buffer, start, rule['width'], max_window):
+            self.record_hit_within(hits, rule, found, base)
+        profiler.record(rule, time.perf_counter_ns() - started, scanned)
+
+    def confirm_set(self, hits, pattern_set, candidates, buffer, start, base, max_window):
+        # One scan of the set per distinct window the candidates need; hits of
+        # other rules in the set are ignored
+        windows = {}
+        for rule in candidates:
+            windows.setdefault(min(rule['width'], max_window), set()).add(id(rule))
+        rules = pattern_set['rules']
+        for width, wanted in windows.items():
+            for found in self.scan_window(pattern_set['compiled'], buffer, start, width, max_window):
+                rule = rules[int(found.lastgroup[1:])]
+                if id(rule) in wanted:
+                    self.record_hit_within(hits, rule, found, base)
+
+    def match_stream(self, state, buffer, count, protocol, max_window=8192, src_port=0, dst_port=0, field=None):
+        # buffer holds the flow's retained bytes and ends with the count new bytes;
+        # the automaton resumes from the state left by the previous segment. The
+        # ports of a flow never change, so neither does its group.
         if not self.built:
             return []
 
-        matches = []
+        if state['scanned'] == 0:
+            # A fresh state on a flow that already has history (the ruleset was
+            # swapped mid-stream) treats the retained bytes as new
+            count = len(buffer)
+
+        group = self.get_group(protocol, src_port, dst_port, field)
+        hits = state['hits']
+        armed = state['armed']
+        skip = state['skip']
+        profiler = self.profiler if self.profiler is not None and self.profiler.sample() else None
+        start = len(buffer) - count
+        base = state['scanned'] - start
+        state['scanned'] += count
+
+        if count and group['automaton'] is not None:
+            folded = fold(buffer[start:])
+            if state['iter'] is None:
+                state['iter'] = group['automaton'].iter(folded)
+            else:
+                state['iter'].set(folded, False)
+
+            for end, (length, rules) in state['iter']:
+                for rule, index in rules:
+                    if rule['depth'] is not None and end >= rule['depth']:
+                        continue
+                    if rule['exact']:
+                        self.record_hit(hits, rule, buffer[max(0, end - base - length + 1):end - base + 1])
+                    else:
+                        if id(rule) not in armed:
+                            armed[id(rule)] = (rule, [None] * len(rule['atoms']))
+                        armed[id(rule)][1][index] = end
+
+        if armed:
+            # A regex is a candidate while all of its atoms were seen close enough
+            # to the new bytes for a match containing them to end there.
+            # Candidates that share a set are confirmed together, except on a
+            # profiled scan or once the set ran out of time on this stream.
+            sets = {}
+            for key, (rule, ends) in list(armed.items()):
+                oldest = start - min(rule['width'], max_window)
+                if all(end is None or end - base < oldest for end in ends):
+                    del armed[key]
+                elif count and all(end is not None and end - base >= oldest for end in ends):
+                    if skip and key in skip:
+                        continue
+                    pattern_set = rule['set']
+                    if pattern_set is not None and profiler is None and id(pattern_set) not in skip:
+                        sets.setdefault(id(pattern_set), (pattern_set, []))[1].append(rule)
+                        continue
+                    state['running'] = rule
+                    self.confirm(hits, rule, buffer, start, base, max_window, profiler)
+            for pattern_set, candidates in sets.values():
+                state['running'] = pattern_set
+                self.confirm_set(hits, pattern_set, candidates, buffer, start, base, max_window)
+
+        if count and group['merged'] is not None:
+            if profiler is not None or id(group) in skip:
+                # A profiled scan runs the merged rules one by one to time each,
+                # and so does a stream the merged pattern ran out of time on
+                for rule in group['merged_rules']:
+                    if skip and id(rule) in skip:
+                        continue
+                    state['running'] = rule
+                    self.confirm(hits, rule, buffer, start, base, max_window, profiler)
+            else:
+                state['running'] = group
+                for found in self.scan_window(group['merged'], buffer, start, group['width'], max_window):
+                    self.record_hit_within(hits, group['merged_rules'][int(found.lastgroup[1:])], found, base)
+
+        if count:
+            for rule in group['standalone']:
+                if rule['depth'] is not None and base + start >= rule['depth']:
+                    continue
+                if skip and id(rule) in skip:
+                    continue
+                state['running'] = rule
+                self.confirm(hits, rule, buffer, start, base, max_window, profiler)
+
+        state['running'] = None
+        return self.stream_hits(state)
+
+    def match_group_batch(self, group, buffers):
+        # One fold and one automaton pass over the concatenated buffers; a hit is
+        # mapped back to its buffer by offset and dropped if it spans two of them.
+        # Regex confirmation runs on each buffer's own slice, so anchors behave
+        # exactly as in match().
+        starts = []
+        offset = 0
+        for data in buffers:
+            starts.append(offset)
+            offset += len(data)
+        joined = b''.join(buffers)
+        view = memoryview(joined)
+        hits = [{} for _ in buffers]
+        candidates = [{} for _ in buffers]
+
+        if group['automaton'] is not None and joined:
+            for end, (length, rules) in group['automaton'].iter(fold(joined)):
+                index = bisect_right(starts, end) - 1
+                start = starts[index]
+                if end - length + 1 < start:
+                    continue
+                for rule, atom in rules:
+                    if rule['depth'] is not None and end - start >= rule['depth']:
+                        continue
+                    if rule['exact']:
+                        self.record_hit(hits[index], rule, view[end - length + 1:end + 1])
+                    else:
+                        candidates[index].setdefault(id(rule), (rule, set()))[1].add(atom)
+
+        for index, data in enumerate(buffers):
+            data = view[starts[index]:starts[index] + len(data)]
+            found_rules = list(group['standalone'])
+            sets = {}
+            for rule, atoms in candidates[index].values():
+                if len(atoms) < len(rule['atoms']):
+                    continue
+                if rule['set'] is not None:
+                    sets.setdefault(id(rule['set']), (rule['set'], set()))[1].add(id(rule))
+                else:
+                    found_rules.append(rule)
+            for rule in found_rules:
+                for found in rule['compiled'].finditer(data):
+                    self.record_hit_within(hits[index], rule, found, 0)
+            for pattern_set, wanted in sets.values():
+                for found in pattern_set['compiled'].finditer(data):
+                    rule = pattern_set['rules'][int(found.lastgroup[1:])]
+                    if id(rule) in wanted:
+                        self.record_hit_within(hits[index], rule, found, 0)
+            if group['merged'] is not None:
+                for found in group['merged'].finditer(data):
+                    self.record_hit_within(hits[index], group['merged_rules'][int(found.lastgroup[1:])], found, 0)
+
+        return [[{"rule_id": rule['id'], "matches": found, "action": rule['action']} for rule, found in buffer_hits.values()]
+                for buffer_hits in hits]
 
+    def match_batch(self, buffers, protocols, ports=None):
+        # Same results as calling match() on every buffer. Buffers are grouped by
+        # the rule group their protocol and ports select; ports is an optional
+        # list of (src_port, dst_port) pairs.
+        if not self.built:
+            return [[] for _ in buffers]
+
+        batches = {}
+        for index, data in enumerate(buffers):
+            if isinstance(data, str):
+                data = data.encode()
+            src_port, dst_port = ports[index] if ports is not None else (0, 0)
+            group = self.get_group(protocols[index], src_port, dst_port)
+            batch = batches.setdefault(id(group), (group, [], []))
+            batch[1].append(index)
+            batch[2].append(data)
+
+        results = [None] * len(buffers)
+        for group, indexes, batch_buffers in batches.values():
+            for index, matches in zip(indexes, self.match_group_batch(group, batch_buffers)):
+                results[index] = matches
+        return results
+
+    def match(self, data, protocol, src_port=0, dst_port=0, field=None):
         if isinstance(data, str):
             data = data.encode()
-        
-        for rule in self.regex_rules:#[b"malware*", b"Backdoor", b"DNS*", b"DHCP*", b"attack", b"shell.php"]:
-            try:
-                if rule['protocol'] == 'any' or rule['protocol'] == protocol:
-                    print(data)
-                    match = {"rule_id":rule['id'], "matches": set(re.compile(rule['regex'], flags=re.IGNORECASE).findall(data)), "action": "drop"}
-                    if len(match['matches']) > 0:
-                        matches.append(match)
-                        print(matches)
-            except Exception as e:
-                print(str(e))
-
-        return matches[::]
+
+        return self.match_stream(self.new_stream(), data, len(data), protocol, len(data), src_port, dst_port, field)
+
+def ruleset_key(rules, backend='auto'):
+    data = json.dumps([CACHE_VERSION, sys.version_info[:2], ahocorasick.unicode, select_backends(backend), rules],
+                      sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+def dumps_ruleset(matcher):
+    data = io.BytesIO()
+    RulesetPickler(data, pickle.HIGHEST_PROTOCOL).dump(matcher)
+    return data.getvalue()
+
+def cache_trusted(st):
+    # The cache is unpickled, so only files and directories no other user can
+    # have written are used
+    return st.st_uid == os.geteuid() and not st.st_mode & 0o022
+
+def compile_ruleset(rules, cache_dir=None, backend='auto'):
+    # Builds a MatcherEngine, or loads the one pickled by an earlier run with
+    # the same rules; loading skips the atom analysis, the automaton build and
+    # (until first use) the regex compiles
+    path = None
+    if cache_dir:
+        cache_dir = os.path.abspath(cache_dir)
+        try:
+            os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+            if cache_trusted(os.stat(cache_dir)):
+                path = os.path.join(cache_dir, f"ruleset-{ruleset_key(rules, backend)}.pickle")
+            else:
+                print(f"Not using ruleset cache {cache_dir}: owned by another user or writable by others")
+        except OSError as e:
+            print(f"Not using ruleset cache {cache_dir}: {e}")
+
+    if path is not None:
+        try:
+            with open(os.open(path, os.O_RDONLY | os.O_NOFOLLOW), 'rb') as f:
+                if cache_trusted(os.fstat(f.fileno())):
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        matcher = pickle.loads(data)
+                    print(f"Loaded compiled ruleset from {path}")
+                    return matcher
+                print(f"Ignoring ruleset cache {path}: owned by another user or writable by others")
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            pass
+
+    matcher = MatcherEngine(backend)
+    matcher.add_rules(rules)
+    matcher.build()
+
+    if path is not None:
+        try:
+            partial = f"{path}.{os.getpid()}"
+            with open(os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600), 'wb') as f:
+                f.write(dumps_ruleset(matcher))
+            os.replace(partial, path)
+        except OSError as e:
+            print(f"Could not write ruleset cache {path}: {e}")
+
+    return matcher
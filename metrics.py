@@ -1,14 +1,65 @@
+import os
 import time
 import json
-from flask import Flask, jsonify
-from multiprocessing import Manager
+import signal
+from flask import Flask, Response, jsonify
+from stats import SharedStats, HISTOGRAMS, LATENCY_BUCKETS, rule_ids
+
+COUNTERS = [
+    ('packets_processed', 'ips_packets_total', 'Packets inspected'),
+    ('bytes_processed', 'ips_bytes_total', 'Bytes of IP packets inspected'),
+    ('packets_dropped', 'ips_packets_dropped_total', 'Packets dropped'),
+    ('packets_accepted', 'ips_packets_accepted_total', 'Packets accepted'),
+    ('matches_found', 'ips_matches_total', 'Packets that matched at least one drop rule'),
+    ('retransmitted_bytes', 'ips_tcp_retransmitted_bytes_total', 'TCP payload bytes skipped because they were already inspected'),
+    ('out_of_order_segments', 'ips_tcp_out_of_order_segments_total', 'TCP segments held back until the gap before them was filled'),
+    ('reassembly_gaps', 'ips_tcp_reassembly_gaps_total', 'Segments matched on their own because they were too far ahead or the out-of-order store was full'),
+    ('expired_flows', 'ips_flows_expired_total', 'Flows removed from the reassembly table after going idle'),
+    ('evicted_flows', 'ips_flows_evicted_total', 'Least recently seen flows evicted because the table was full'),
+    ('rejected_flows', 'ips_flows_rejected_total', 'New flows not tracked because the table was full'),
+    ('truncated_flows', 'ips_flows_truncated_total', 'Flows no longer inspected past pressure_inspect_bytes under memory pressure'),
+    ('pressure_evictions', 'ips_flows_pressure_evicted_total', 'Flows evicted to stay within the reassembly memory budget'),
+    ('cached_verdicts', 'ips_cached_verdicts_total', 'Packets decided from their flow verdict without matching'),
+    ('offloaded_flows', 'ips_flows_offloaded_total', 'Flow verdicts handed to the kernel through conntrack marks'),
+    ('decoded_fields', 'ips_decoded_fields_total', 'Inspection buffers extracted by the protocol decoders'),
+    ('decoder_failures', 'ips_decoder_failures_total', 'Flows whose decoder stopped on traffic it could not parse'),
+    ('budget_exceeded', 'ips_inspection_budget_exceeded_total', 'Packets accepted because matching ran past packet_budget_ms'),
+    ('worker_restarts', 'ips_worker_restarts_total', 'Times the worker was restarted after dying or getting stuck'),
+    ('dropped_alerts', 'ips_alerts_dropped_total', 'Alerts lost because the alert buffer was full'),
+    ('suppressed_alerts', 'ips_alerts_aggregated_total', 'Repeated hits folded into an aggregated alert record'),
+    ('rate_limited_packets', 'ips_packets_rate_limited_total', 'Packets dropped because their source was over the blocklist rate limit'),
+    ('blocked_packets', 'ips_packets_blocked_total', 'Packets from banned sources dropped by the worker before the kernel set had them'),
+    ('source_bans', 'ips_source_bans_total', 'Sources banned after repeated drop rule hits')
+]
+
+GAUGES = [
+    ('active_flows', 'ips_active_flows', 'Flows in the reassembly table'),
+    ('total_buffer_size', 'ips_reassembly_buffered_bytes', 'Stream bytes retained for matching'),
+    ('buffer_memory', 'ips_reassembly_memory_bytes', 'Memory allocated for reassembly buffers'),
+    ('memory_used', 'ips_reassembly_memory_used_bytes', 'Estimated reassembly memory counted against the budget'),
+    ('memory_pressure', 'ips_reassembly_memory_pressure', '1 while the reassembler is degrading to stay within its memory budget'),
+    ('ruleset_generation', 'ips_ruleset_generation', 'Ruleset generation the worker is matching with'),
+    ('tracked_sources', 'ips_tracked_sources', 'Source addresses in the blocklist table'),
+    ('pending_alerts', 'ips_pending_alerts', 'Alerts waiting to be flushed')
+]
+
+# Per-rule cost, counted on profiled scans only (rule_profile_sample_rate)
+RULE_COUNTERS = [
+    ('evaluations', 'ips_rule_evaluations_total', 'Profiled regex evaluations per rule'),
+    ('scanned_bytes', 'ips_rule_scanned_bytes_total', 'Bytes scanned by the rule on profiled evaluations'),
+    ('slow_scans', 'ips_rule_slow_scans_total', 'Profiled evaluations slower than slow_rule_threshold_us')
+]
+
+HISTOGRAM_METRICS = {
+    'verdict_latency': ('ips_verdict_latency_seconds', 'Time from receiving a packet to issuing its verdict'),
+    'scan_time': ('ips_scan_time_seconds', 'Time spent in the matcher per packet')
+}
 
 class MetricsServer:
     def __init__(self, config):
         self.app = Flask(__name__)
         self.config = config
-        self.manager = Manager()
-        self.shared_stats = self.manager.dict()
+        self.shared_stats = SharedStats(config.get('queues', 4), rule_ids(config))
         self.start_time = time.time()
 
         self.setup_routes()
@@ -25,6 +76,7 @@ class MetricsServer:
                 'matches_found': 0,
                 'packets_dropped': 0,
                 'packets_accepted': 0,
+                'bytes_processed': 0,
                 'active_flows': 0,
                 'total_buffer_size': 0,
                 'pending_alerts': 0,
@@ -32,11 +84,13 @@ class MetricsServer:
                 'workers': {}
             }
 
-            for queue_id, worker_stats in self.shared_stats.items():
+            for queue_id in range(self.shared_stats.workers):
+                worker_stats = self.shared_stats.read(queue_id)
                 total_stats['packets_processed'] += worker_stats.get('packets_processed', 0)
                 total_stats['matches_found'] += worker_stats.get('matches_found', 0)
                 total_stats['packets_dropped'] += worker_stats.get('packets_dropped', 0)
                 total_stats['packets_accepted'] += worker_stats.get('packets_accepted', 0)
+                total_stats['bytes_processed'] += worker_stats.get('bytes_processed', 0)
                 total_stats['active_flows'] += worker_stats.get('active_flows', 0)
                 total_stats['total_buffer_size'] += worker_stats.get('total_buffer_size', 0)
                 total_stats['pending_alerts'] += worker_stats.get('pending_alerts', 0)
@@ -46,14 +100,96 @@ class MetricsServer:
 
         @self.app.route('/stats/<int:queue_id>')
         def worker_stats(queue_id):
-            if queue_id in self.shared_stats:
-                stats = dict(self.shared_stats[queue_id])
+            if 0 <= queue_id < self.shared_stats.workers:
+                stats = self.shared_stats.read(queue_id)
                 stats['uptime'] = time.time() - self.start_time
                 return jsonify(stats)
             return jsonify({'error': 'Worker not found'}), 404
 
-    def update_worker_stats(self, queue_id, stats):
-        self.shared_stats[queue_id] = stats
+        @self.app.route('/reload', methods=['POST'])
+        def reload():
+            # The metrics server runs as a child of the main process, which
+            # compiles the rules and hands them to the workers
+            os.kill(os.getppid(), signal.SIGHUP)
+            return jsonify({'status': 'reloading'}), 202
+
+        @self.app.route('/metrics')
+        def metrics():
+            return Response(self.prometheus_text(), mimetype='text/plain; version=0.0.4')
+
+    def prometheus_text(self):
+        lines = []
+        queues = range(self.shared_stats.workers)
+        workers = [self.shared_stats.read(queue_id) for queue_id in queues]
+
+        for field, name, help_text in COUNTERS:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for stats in workers:
+                lines.append(f'{name}{{queue="{stats["queue_id"]}"}} {stats[field]}')
+
+        for field, name, help_text in GAUGES:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for stats in workers:
+                lines.append(f'{name}{{queue="{stats["queue_id"]}"}} {stats[field]}')
+
+        now = time.monotonic_ns()
+        lines.append("# HELP ips_worker_busy_seconds How long the worker has been handling its current packet")
+        lines.append("# TYPE ips_worker_busy_seconds gauge")
+        for stats in workers:
+            busy = (now - stats['busy_since']) / 1e9 if stats['busy_since'] else 0
+            lines.append(f'ips_worker_busy_seconds{{queue="{stats["queue_id"]}"}} {busy}')
+
+        lines.append("# HELP ips_worker_heartbeat_age_seconds Time since the worker last finished a packet")
+        lines.append("# TYPE ips_worker_heartbeat_age_seconds gauge")
+        for stats in workers:
+            age = (now - stats['heartbeat']) / 1e9 if stats['heartbeat'] else 0
+            lines.append(f'ips_worker_heartbeat_age_seconds{{queue="{stats["queue_id"]}"}} {age}')
+
+        rules = [self.shared_stats.read_rules(queue_id) for queue_id in queues]
+        lines.append("# HELP ips_rule_hits_total Packets dropped per matching rule")
+        lines.append("# TYPE ips_rule_hits_total counter")
+        for queue_id in queues:
+            for rule_id, stats in rules[queue_id].items():
+                lines.append(f'ips_rule_hits_total{{queue="{queue_id}",rule_id="{rule_id}"}} {stats["hits"]}')
+
+        for field, name, help_text in RULE_COUNTERS:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for queue_id in queues:
+                for rule_id, stats in rules[queue_id].items():
+                    lines.append(f'{name}{{queue="{queue_id}",rule_id="{rule_id}"}} {stats[field]}')
+
+        lines.append("# HELP ips_rule_scan_seconds_total Time spent in the rule on profiled evaluations")
+        lines.append("# TYPE ips_rule_scan_seconds_total counter")
+        for queue_id in queues:
+            for rule_id, stats in rules[queue_id].items():
+                lines.append(f'ips_rule_scan_seconds_total{{queue="{queue_id}",rule_id="{rule_id}"}} {stats["scan_ns"] / 1e9}')
+
+        lines.append("# HELP ips_rule_disabled 1 if the worker disabled the rule for being too slow")
+        lines.append("# TYPE ips_rule_disabled gauge")
+        for queue_id in queues:
+            for rule_id, stats in rules[queue_id].items():
+                lines.append(f'ips_rule_disabled{{queue="{queue_id}",rule_id="{rule_id}"}} {stats["disabled"]}')
+
+        for histogram in HISTOGRAMS:
+            name, help_text = HISTOGRAM_METRICS[histogram]
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for queue_id in queues:
+                buckets, total = self.shared_stats.read_histogram(queue_id, histogram)
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ['+Inf'], buckets):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{queue="{queue_id}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_sum{{queue="{queue_id}"}} {total}')
+                lines.append(f'{name}_count{{queue="{queue_id}"}} {cumulative}')
+
+        lines.append("# HELP ips_uptime_seconds Time since the metrics server started")
+        lines.append("# TYPE ips_uptime_seconds gauge")
+        lines.append(f"ips_uptime_seconds {time.time() - self.start_time}")
+        return '\n'.join(lines) + '\n'
 
     def run(self):
         host = self.config.get('http_metrics', {}).get('host', '127.0.0.1')
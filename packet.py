@@ -0,0 +1,69 @@
+import struct
+
+# Only the header fields the pipeline uses, read straight out of the packet
+# bytes NFQUEUE hands over (which start at the IP header)
+IPV4_HEADER = struct.Struct('!BxHxxHxB2x4s4s')   # version/IHL, total length, flags/fragment offset, protocol, addresses
+IPV6_HEADER = struct.Struct('!B3xHBx16s16s')     # version, payload length, next header, addresses
+TCP_HEADER = struct.Struct('!HHI4xBB')           # ports, sequence number, data offset, flags
+UDP_HEADER = struct.Struct('!HH')                # ports
+
+PROTO_ICMP = 1
+PROTO_TCP = 6
+PROTO_UDP = 17
+PROTO_ICMPV6 = 58
+
+TH_FIN = 0x01
+TH_SYN = 0x02
+TH_RST = 0x04
+TH_ACK = 0x10
+
+ICMPV6_ECHO_REQUEST = 128
+ICMPV6_ECHO_REPLY = 129
+
+# IPv6 extension headers walked to reach the transport header
+IPV6_HOP_BY_HOP = 0
+IPV6_ROUTING = 43
+IPV6_FRAGMENT = 44
+IPV6_AUTH = 51
+IPV6_DEST_OPTIONS = 60
+IPV6_EXTENSIONS = frozenset((IPV6_HOP_BY_HOP, IPV6_ROUTING, IPV6_FRAGMENT, IPV6_AUTH, IPV6_DEST_OPTIONS))
+
+def parse_ip(data):
+    # (source, destination, protocol, transport header offset, end of the IP
+    # packet) with the addresses as raw bytes, or None when there is no
+    # transport header to look at: not IPv4/IPv6, truncated, or a fragment
+    # other than the first
+    if not data:
+        return None
+
+    version = data[0] >> 4
+    if version == 4:
+        if len(data) < 20:
+            return None
+        version_ihl, total_length, fragment, protocol, src, dst = IPV4_HEADER.unpack_from(data)
+        if fragment & 0x1fff:
+            return None
+        return src, dst, protocol, (version_ihl & 0x0f) * 4, min(total_length, len(data))
+
+    if version == 6:
+        if len(data) < 40:
+            return None
+        _, payload_length, protocol, src, dst = IPV6_HEADER.unpack_from(data)
+        end = min(40 + payload_length, len(data))
+        offset = 40
+        while protocol in IPV6_EXTENSIONS:
+            if offset + 8 > end:
+                return None
+            if protocol == IPV6_FRAGMENT:
+                if (data[offset + 2] << 8 | data[offset + 3]) & 0xfff8:
+                    return None
+                length = 8
+            elif protocol == IPV6_AUTH:
+                length = (data[offset + 1] + 2) * 4
+            else:
+                length = (data[offset + 1] + 1) * 8
+            protocol = data[offset]
+            offset += length
+        return src, dst, protocol, offset, end
+
+    return None
@@ -0,0 +1,45 @@
+from stats import RULE_EVALUATIONS, RULE_SCAN_NS, RULE_SCANNED_BYTES, RULE_SLOW_SCANS
+
+class RuleProfiler:
+    # The matcher asks sample() once per scan; on one scan in sample_every it
+    # confirms every candidate rule with its own pattern and reports the time
+    # and bytes of each. Literal rules confirmed by the automaton alone are
+    # never timed, their cost is in the automaton pass shared by all rules.
+    def __init__(self, counters, slots, sample_every, slow_threshold_ns=0, slow_strikes=3):
+        self.counters = counters
+        self.slots = slots
+        self.sample_every = sample_every
+        self.countdown = sample_every
+        self.slow_threshold_ns = slow_threshold_ns
+        self.slow_strikes = slow_strikes
+        self.strikes = {}
+        # Rules that were slow on slow_strikes profiled scans, for the worker
+        # to report or disable between packets
+        self.slow_rules = []
+
+    def sample(self):
+        self.countdown -= 1
+        if self.countdown:
+            return False
+        self.countdown = self.sample_every
+        return True
+
+    def record(self, rule, elapsed_ns, scanned_bytes):
+        slot = self.slots.get(rule['id'])
+        if slot is None:
+            return
+
+        counters = self.counters
+        counters[slot + RULE_EVALUATIONS] += 1
+        counters[slot + RULE_SCAN_NS] += elapsed_ns
+        counters[slot + RULE_SCANNED_BYTES] += scanned_bytes
+
+        if self.slow_threshold_ns and elapsed_ns > self.slow_threshold_ns:
+            counters[slot + RULE_SLOW_SCANS] += 1
+            strikes = self.strikes[rule['id']] = self.strikes.get(rule['id'], 0) + 1
+            if strikes == self.slow_strikes:
+                self.slow_rules.append(rule['id'])
+
+    def reset(self):
+        self.strikes = {}
+        self.slow_rules = []
@@ -1,63 +1,397 @@
 import time
-from collections import defaultdict, deque
+from collections import OrderedDict
+
+class StreamBuffer:
+    # Keeps the last `capacity` bytes of a stream in one preallocated bytearray.
+    # Writes go to the tail; when the tail hits the end the retained bytes are
+    # moved to the front, so every window handed out is a contiguous view.
+    __slots__ = ('data', 'start', 'end', 'capacity')
+
+    def __init__(self, capacity):
+        self.data = None
+        self.start = 0
+        self.end = 0
+        self.capacity = capacity
+
+    def __len__(self):
+        return self.end - self.start
+
+    def append(self, chunk, slack=None):
+        # slack is the spare room left behind the data when (re)allocating;
+        # with none the buffer is kept as small as the window allows
+        size = len(chunk)
+        slack = self.capacity if slack is None else slack
+        if self.data is None:
+            self.data = bytearray(size + slack)
+
+        keep = min(self.end - self.start, self.capacity)
+        if self.end + size > len(self.data):
+            if keep + size > len(self.data) or keep + size + slack < len(self.data) // 2:
+                data = bytearray(keep + size + slack)
+                data[:keep] = self.data[self.end - keep:self.end]
+                self.data = data
+            else:
+                self.data[:keep] = self.data[self.end - keep:self.end]
+            self.end = keep
+
+        window_start = self.end - keep
+        self.data[self.end:self.end + size] = chunk
+        self.end += size
+        self.start = max(window_start, self.end - self.capacity)
+        return memoryview(self.data)[window_start:self.end]
+
+    def memory(self):
+        return len(self.data) if self.data is not None else 0
+
+    def view(self, size=None):
+        if self.data is None:
+            return memoryview(b'')
+        start = self.start if size is None else max(self.start, self.end - size)
+        return memoryview(self.data)[start:self.end]
+
+# Rough cost of a flow besides its buffers: the flow record, its table entry
+# and the matcher's per-stream state
+FLOW_OVERHEAD = 1024
+
+def seq_diff(a, b):
+    # Signed distance a - b in 32-bit TCP sequence space
+    return ((a - b + 0x80000000) & 0xffffffff) - 0x80000000
+
+class Flow:
+    __slots__ = ('buffer', 'last_seen', 'state', 'scan_state', 'next_seq', 'ooo', 'ooo_bytes',
+                 'delivered', 'truncated', 'verdict', 'verdict_rules', 'ct_dir', 'offloaded', 'decoder')
+
+    def __init__(self, buffer_size, now):
+        self.buffer = StreamBuffer(buffer_size)
+        self.last_seen = now
+        self.state = 'active'
+        self.scan_state = None
+        self.next_seq = None
+        self.ooo = None
+        self.ooo_bytes = 0
+        self.delivered = 0
+        self.truncated = False
+        # Set once the flow is decided ('accept' or 'drop'); ct_dir is the
+        # conntrack direction ('original'/'reply') when the handshake was seen
+        self.verdict = None
+        self.verdict_rules = None
+        self.ct_dir = None
+        self.offloaded = False
+        # Application-layer decoder for the client side of a known service
+        self.decoder = None
 
 class StreamReassembler:
-    def __init__(self, max_buffer_size=65536, flow_timeout=60):
-        self.flows = defaultdict(lambda: {
-            'buffer': bytearray(),
-            'last_seen': time.time(),
-            'state': 'active'
-        })
+    def __init__(self, max_buffer_size=65536, flow_timeout=60, scan_window=8192,
+                 max_ooo_segments=32, max_ooo_bytes=65536, overlap_policy='first',
+                 max_flows=100000, eviction_policy='lru', closed_timeout=10, expire_budget=8,
+                 memory_budget=0, pressure_inspect_bytes=16384):
+        # Only the scan window is ever handed to the matcher, so that is all a flow
+        # retains; callers pass the longest match the ruleset can need
+        self.buffer_size = min(max_buffer_size, scan_window)
+        # Flows are kept in least recently seen order, so the expired ones are
+        # always at the front and expiry never has to walk the whole table
+        self.flows = OrderedDict()
         self.max_buffer_size = max_buffer_size
         self.flow_timeout = flow_timeout
+        self.closed_timeout = min(closed_timeout, flow_timeout)
+        self.expire_budget = expire_budget
+        self.max_flows = max_flows
+        self.eviction_policy = eviction_policy
+        self.max_ooo_segments = max_ooo_segments
+        self.max_ooo_bytes = max_ooo_bytes
+        self.overlap_policy = overlap_policy
+        self.buffered_bytes = 0
+        self.buffer_memory = 0
+        self.retransmitted_bytes = 0
+        self.out_of_order_segments = 0
+        self.overlap_conflicts = 0
+        self.reassembly_gaps = 0
+        self.expired_flows = 0
+        self.evicted_flows = 0
+        self.rejected_flows = 0
+        self.memory_budget = memory_budget
+        self.pressure_inspect_bytes = pressure_inspect_bytes
+        self.under_pressure = False
+        self.total_ooo_bytes = 0
+        self.truncated_flows = 0
+        self.pressure_evictions = 0
 
     def get_flow_key(self, src_ip, src_port, dst_ip, dst_port, protocol):
-        return (src_ip, src_port, dst_ip, dst_port, protocol)
+        # src_ip/dst_ip are the raw address bytes from the IP header and protocol
+        # the IP protocol number; the 5-tuple is packed into a single int, with
+        # bit 40 set for IPv6 so no IPv4 and IPv6 tuple share a key
+        return ((int.from_bytes(src_ip + dst_ip, 'big') << 41) | ((len(src_ip) == 16) << 40)
+                | (src_port << 24) | (dst_port << 8) | protocol)
+
+    def track_flow(self, flow_key, now):
+        flow = self.flows.get(flow_key)
+        if flow is not None:
+            flow.last_seen = now
+            self.flows.move_to_end(flow_key)
+            return flow
+
+        self.expire_flows(now, self.expire_budget)
+        if len(self.flows) >= self.max_flows:
+            if self.eviction_policy == 'reject':
+                self.rejected_flows += 1
+                return None
+            self.remove_flow(next(iter(self.flows)))
+            self.evicted_flows += 1
+
+        flow = Flow(self.buffer_size, now)
+        self.flows[flow_key] = flow
+        return flow
+
+    def release(self, flow):
+        # Frees everything buffered for the flow; it keeps its sequence state
+        self.buffered_bytes -= len(flow.buffer) + flow.ooo_bytes
+        self.buffer_memory -= flow.buffer.memory()
+        self.total_ooo_bytes -= flow.ooo_bytes
+        flow.buffer = StreamBuffer(self.buffer_size)
+        flow.ooo = None
+        flow.ooo_bytes = 0
+
+    def remove_flow(self, flow_key):
+        self.release(self.flows.pop(flow_key))
+
+    def memory_used(self):
+        return self.buffer_memory + self.total_ooo_bytes + len(self.flows) * FLOW_OVERHEAD
+
+    def check_pressure(self, flow_key, flow):
+        # Above 80% of the budget buffers are allocated without slack and flows
+        # are only inspected up to pressure_inspect_bytes; above the budget the
+        # least recently seen flows are evicted, a few per packet
+        used = self.memory_used()
+        self.under_pressure = used > self.memory_budget * 0.8
+        if not self.under_pressure:
+            return
+
+        if flow.delivered > self.pressure_inspect_bytes and not flow.truncated:
+            self.release(flow)
+            flow.truncated = True
+            self.truncated_flows += 1
+            used = self.memory_used()
+
+        evicted = 0
+        while used > self.memory_budget and evicted < self.expire_budget:
+            oldest = next(iter(self.flows))
+            if oldest == flow_key:
+                break
+            self.remove_flow(oldest)
+            evicted += 1
+            used = self.memory_used()
+        self.pressure_evictions += evicted
+
+    def expire_flows(self, now, budget=None):
+        # Closed flows linger for closed_timeout so late retransmissions still
+        # hit their flow; the scan stops at the first flow that is still live
+        expired = 0
+        while self.flows and (budget is None or expired < budget):
+            flow_key, flow = next(iter(self.flows.items()))
+            timeout = self.closed_timeout if flow.state == 'closed' else self.flow_timeout
+            if now - flow.last_seen <= timeout:
+                break
+            self.remove_flow(flow_key)
+            expired += 1
+        self.expired_flows += expired
+        return expired
 
-    def add_tcp_segment(self, flow_key, data):
-        flow = self.flows[flow_key]
-        flow['last_seen'] = time.time()
+    def append(self, flow, data):
+        buffer = flow.buffer
+        retained = len(buffer)
+        memory = buffer.memory()
+        flow.delivered += len(data)
+        window = buffer.append(data, 0 if self.under_pressure else None)
+        self.buffered_bytes += len(buffer) - retained
+        self.buffer_memory += buffer.memory() - memory
+        return window
 
-        if len(flow['buffer']) + len(data) > self.max_buffer_size:
-            overflow = len(flow['buffer']) + len(data) - self.max_buffer_size
-            flow['buffer'] = flow['buffer'][overflow:]
+    def trim_overlap(self, flow, seq, data):
+        # Returns the bytes to deliver and how far they advance next_seq. Bytes
+        # that were already delivered are cut, except with the 'last' policy
+        # where rewritten bytes that are still retained are delivered again.
+        behind = -seq_diff(seq, flow.next_seq)
+        if behind <= 0:
+            return data, len(data)
 
-        flow['buffer'].extend(data)
-        return flow['buffer']
+        overlap = min(behind, len(data))
+        retained = flow.buffer.view()
+        if behind <= len(retained):
+            previous = retained[len(retained) - behind:len(retained) - behind + overlap]
+            if previous != data[:overlap]:
+                self.overlap_conflicts += 1
+                if self.overlap_policy == 'last':
+                    return data, len(data) - overlap
+
+        self.retransmitted_bytes += overlap
+        return data[overlap:], len(data) - overlap
+
+    def store_out_of_order(self, flow, seq, data):
+        # Returns False for a segment that is not held back: one ending more
+        # than max_ooo_bytes past next_seq, or one the store has no room for.
+        # next_seq only ever moves over delivered bytes, so the hole stays open.
+        if flow.ooo is None:
+            flow.ooo = {}
+        if seq in flow.ooo and len(flow.ooo[seq]) >= len(data):
+            self.retransmitted_bytes += len(data)
+            return True
+
+        previous = len(flow.ooo.get(seq, b''))
+        if (seq_diff(seq, flow.next_seq) + len(data) > self.max_ooo_bytes
+                or (not previous and len(flow.ooo) >= self.max_ooo_segments)
+                or flow.ooo_bytes + len(data) - previous > self.max_ooo_bytes):
+            self.reassembly_gaps += 1
+            return False
+
+        self.out_of_order_segments += 1
+        flow.ooo[seq] = bytes(data)
+        flow.ooo_bytes += len(data) - previous
+        self.total_ooo_bytes += len(data) - previous
+        self.buffered_bytes += len(data) - previous
+        return True
+
+    def drain_out_of_order(self, flow):
+        delivered = []
+        while flow.ooo:
+            seq = min(flow.ooo, key=lambda stored: seq_diff(stored, flow.next_seq))
+            if seq_diff(seq, flow.next_seq) > 0:
+                break
+
+            data = flow.ooo.pop(seq)
+            flow.ooo_bytes -= len(data)
+            self.total_ooo_bytes -= len(data)
+            self.buffered_bytes -= len(data)
+            data, advance = self.trim_overlap(flow, seq, data)
+            if data:
+                delivered.append(data)
+                flow.next_seq = (flow.next_seq + advance) & 0xffffffff
+        return delivered
+
+    def add_tcp_segment(self, flow_key, data, seq=None, syn=False):
+        # Returns a view of the retained history followed by the newly delivered
+        # in-order bytes, and how many of the bytes at the end of it are new.
+        # When the table is full and new flows are rejected the segment is
+        # returned on its own; so is a segment too far ahead of the stream to
+        # hold back, with None for the count.
+        flow = self.track_flow(flow_key, time.time())
+        if flow is None:
+            return data, len(data)
+        if flow.truncated:
+            return flow.buffer.view(), 0
+
+        window, count = self.reassemble(flow, data, seq, syn)
+        if self.memory_budget:
+            self.check_pressure(flow_key, flow)
+        return window, count
+
+    def reassemble(self, flow, data, seq, syn):
+        if seq is None:
+            return self.append(flow, data), len(data)
+
+        if syn:
+            seq = (seq + 1) & 0xffffffff
+            # Only the SYN that opens the stream sets where it starts; a later
+            # one that does not match it is no part of the stream, and any
+            # data it carries is matched on its own
+            if flow.next_seq is None:
+                flow.next_seq = seq
+            elif seq != flow.next_seq:
+                return (data, None) if data else (flow.buffer.view(), 0)
+        elif flow.next_seq is None:
+            flow.next_seq = seq
+
+        if not data:
+            return flow.buffer.view(), 0
+
+        if seq_diff(seq, flow.next_seq) > 0:
+            if not self.store_out_of_order(flow, seq, data):
+                return data, None
+            delivered = self.drain_out_of_order(flow)
+        else:
+            data, advance = self.trim_overlap(flow, seq, data)
+            delivered = [data] if data else []
+            flow.next_seq = (flow.next_seq + advance) & 0xffffffff
+            if flow.ooo:
+                delivered.extend(self.drain_out_of_order(flow))
+
+        if not delivered:
+            return flow.buffer.view(), 0
+
+        data = delivered[0] if len(delivered) == 1 else b''.join(delivered)
+        return self.append(flow, data), len(data)
 
     def add_udp_datagram(self, flow_key, data):
-        flow = self.flows[flow_key]
-        flow['last_seen'] = time.time()
-        flow['buffer'] = bytearray(data)
-        return flow['buffer']
+        # Datagrams are matched one at a time, nothing needs to be retained
+        # and no flow is tracked for them
+        return data
+
+    def reset_flow(self, flow_key, seq):
+        # A SYN without ACK on a 5-tuple the table holds. It opens a new
+        # connection, and the old flow (verdict, stream, decoder) is forgotten,
+        # once that flow closed or when the SYN is nowhere near its stream; the
+        # receiver ignores any other SYN. A dropped flow is only ever forgotten
+        # by expiry, so a SYN can't let its data through again.
+        flow = self.flows.get(flow_key)
+        if flow is None or flow.verdict == 'drop':
+            return
+        if (flow.state == 'closed' or flow.next_seq is None
+                or abs(seq_diff((seq + 1) & 0xffffffff, flow.next_seq)) > self.max_ooo_bytes):
+            self.remove_flow(flow_key)
+
+    def cached_flow(self, flow_key):
+        # Returns the flow if it already has a verdict, refreshing its place in
+        # the expiry order; its packets skip reassembly and matching
+        flow = self.flows.get(flow_key)
+        if flow is None or flow.verdict is None:
+            return None
+        flow.last_seen = time.time()
+        self.flows.move_to_end(flow_key)
+        return flow
+
+    def set_verdict(self, flow, verdict, rules=None):
+        self.release(flow)
+        flow.scan_state = None
+        flow.verdict = verdict
+        flow.verdict_rules = rules
+
+    def reset_streams(self, scan_window):
+        # After a ruleset swap the matcher state of every flow belongs to the old
+        # ruleset and is dropped; reassembly state and buffered bytes are kept
+        self.buffer_size = min(self.max_buffer_size, scan_window)
+        for flow in self.flows.values():
+            flow.scan_state = None
+            flow.buffer.capacity = self.buffer_size
+
+    def get_flow(self, flow_key):
+        return self.flows.get(flow_key)
 
     def get_buffer(self, flow_key, max_scan_window=8192):
         if flow_key not in self.flows:
-            return bytearray()
+            return memoryview(b'')
 
-        buffer = self.flows[flow_key]['buffer']
-        if len(buffer) > max_scan_window:
-            return buffer[-max_scan_window:]
-        return buffer
+        return self.flows[flow_key].buffer.view(max_scan_window)
 
     def close_flow(self, flow_key):
         if flow_key in self.flows:
-            self.flows[flow_key]['state'] = 'closed'
+            self.flows[flow_key].state = 'closed'
 
     def prune_flows(self):
-        current_time = time.time()
-        expired_flows = []
-
-        for flow_key, flow in self.flows.items():
-            if (current_time - flow['last_seen'] > self.flow_timeout or
-                flow['state'] == 'closed'):
-                expired_flows.append(flow_key)
-
-        for flow_key in expired_flows:
-            del self.flows[flow_key]
+        return self.expire_flows(time.time())
 
     def get_stats(self):
         return {
             'active_flows': len(self.flows),
-            'total_buffer_size': sum(len(f['buffer']) for f in self.flows.values())
+            'total_buffer_size': self.buffered_bytes,
+            'buffer_memory': self.buffer_memory,
+            'retransmitted_bytes': self.retransmitted_bytes,
+            'out_of_order_segments': self.out_of_order_segments,
+            'overlap_conflicts': self.overlap_conflicts,
+            'reassembly_gaps': self.reassembly_gaps,
+            'expired_flows': self.expired_flows,
+            'evicted_flows': self.evicted_flows,
+            'rejected_flows': self.rejected_flows,
+            'memory_used': self.memory_used(),
+            'memory_pressure': int(self.under_pressure),
+            'truncated_flows': self.truncated_flows,
+            'pressure_evictions': self.pressure_evictions
         }
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+import gc
+import sys
+import time
+import random
+import socket
+import argparse
+import yaml
+import dpkt
+from matcher import MatcherEngine
+from worker import PacketWorker, NF_INET_LOCAL_IN
+from stats import RULE_EVALUATIONS, RULE_SCAN_NS
+
+class ReplayPacket:
+    # Stands in for netfilterqueue.Packet; records the verdict instead of issuing it
+    def __init__(self, payload):
+        self.payload = payload
+        self.verdict = None
+        self.mark = 0
+        # Replayed traffic is treated as arriving at the host (INPUT)
+        self.hook = NF_INET_LOCAL_IN
+
+    def get_payload(self):
+        return self.payload
+
+    def get_payload_len(self):
+        return len(self.payload)
+
+    def accept(self):
+        self.verdict = 'accept'
+
+    def drop(self):
+        self.verdict = 'drop'
+
+    def repeat(self):
+        self.verdict = 'repeat'
+
+    def set_mark(self, mark):
+        self.mark = mark
+
+    def get_mark(self):
+        return self.mark
+
+def read_pcap(path):
+    packets = []
+    with open(path, 'rb') as f:
+        try:
+            reader = dpkt.pcap.Reader(f)
+        except ValueError:
+            f.seek(0)
+            reader = dpkt.pcapng.Reader(f)
+
+        linktype = reader.datalink()
+        for _, buf in reader:
+            if linktype == dpkt.pcap.DLT_EN10MB:
+                frame = dpkt.ethernet.Ethernet(buf)
+                if not isinstance(frame.data, (dpkt.ip.IP, dpkt.ip6.IP6)):
+                    continue
+                packets.append(bytes(frame.data))
+            elif linktype == dpkt.pcap.DLT_LINUX_SLL:
+                frame = dpkt.sll.SLL(buf)
+                if not isinstance(frame.data, (dpkt.ip.IP, dpkt.ip6.IP6)):
+                    continue
+                packets.append(bytes(frame.data))
+            else:
+                packets.append(bytes(buf))
+    return packets
+
+def write_pcap(path, packets):
+    with open(path, 'wb') as f:
+        writer = dpkt.pcap.Writer(f, linktype=dpkt.pcap.DLT_RAW)
+        now = time.time()
+        for index, packet in enumerate(packets):
+            writer.writepkt(packet, ts=now + index * 0.0001)
+
+def ip_packet(src, dst, protocol, data):
+    ip = dpkt.ip.IP(src=src, dst=dst, p=protocol, data=data)
+    ip.len += len(data)
+    return bytes(ip)
+
+def tcp_flow(rng, client, server, request, response, sport, dport, mss=1460):
+    packets = []
+    client_seq = rng.randrange(1 << 32)
+    server_seq = rng.randrange(1 << 32)
+
+    def segment(src, dst, sport, dport, seq, ack, flags, data=b''):
+        tcp = dpkt.tcp.TCP(sport=sport, dport=dport, seq=seq & 0xffffffff, ack=ack & 0xffffffff, flags=flags, data=data)
+        packets.append(ip_packet(src, dst, dpkt.ip.IP_PROTO_TCP, tcp))
+
+    segment(client, server, sport, dport, client_seq, 0, dpkt.tcp.TH_SYN)
+    segment(server, client, dport, sport, server_seq, client_seq + 1, dpkt.tcp.TH_SYN | dpkt.tcp.TH_ACK)
+    client_seq += 1
+    server_seq += 1
+
+    for offset in range(0, len(request), mss):
+        chunk = request[offset:offset + mss]
+        segment(client, server, sport, dport, client_seq, server_seq, dpkt.tcp.TH_ACK | dpkt.tcp.TH_PUSH, chunk)
+        client_seq += len(chunk)
+
+    for offset in range(0, len(response), mss):
+        chunk = response[offset:offset + mss]
+        segment(server, client, dport, sport, server_seq, client_seq, dpkt.tcp.TH_ACK | dpkt.tcp.TH_PUSH, chunk)
+        server_seq += len(chunk)
+
+    segment(client, server, sport, dport, client_seq, server_seq, dpkt.tcp.TH_FIN | dpkt.tcp.TH_ACK)
+    segment(server, client, dport, sport, server_seq, client_seq + 1, dpkt.tcp.TH_FIN | dpkt.tcp.TH_ACK)
+    return packets
+
+def random_text(rng, size):
+    alphabet = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/= \r\n'
+    return bytes(rng.choice(alphabet) for _ in range(size))
+
+def synthetic_corpus(matcher, flows, attack_ratio, seed):
+    # Mixed HTTP-like TCP flows, DNS-like UDP datagrams and pings; a fraction of
+    # them carry one of the literal signatures from the ruleset at a random offset.
+    # Only signatures without port, depth or field constraints are used, so
+    # every planted one is expected to be dropped.
+    rng = random.Random(seed)
+    signatures = [rule['literal'] for rule in matcher.regex_rules
+                  if rule.get('literal') and not rule['ports'] and rule['depth'] is None and not rule['field']]
+    packets = []
+
+    for index in range(flows):
+        client = socket.inet_aton(f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}")
+        server = socket.inet_aton(f"192.168.{rng.randrange(256)}.{rng.randrange(1, 255)}")
+        attack = signatures and rng.random() < attack_ratio
+        kind = rng.random()
+
+        if kind < 0.8:
+            path = random_text(rng, 12).replace(b' ', b'').replace(b'\r', b'').replace(b'\n', b'')
+            request = b"GET /" + path + b" HTTP/1.1\r\nHost: example.com\r\nUser-Agent: replay\r\n\r\n"
+            response = b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n\r\n" + random_text(rng, rng.randrange(200, 20000))
+            if attack:
+                signature = rng.choice(signatures)
+                cut = rng.randrange(len(response))
+                response = response[:cut] + signature + response[cut:]
+            packets.extend(tcp_flow(rng, client, server, request, response, rng.randrange(1024, 65535), 80))
+        elif kind < 0.95:
+            data = random_text(rng, rng.randrange(20, 200))
+            if attack:
+                data += rng.choice(signatures)
+            udp = dpkt.udp.UDP(sport=rng.randrange(1024, 65535), dport=53, data=data)
+            udp.ulen = len(udp)
+            packets.append(ip_packet(client, server, dpkt.ip.IP_PROTO_UDP, udp))
+        else:
+            icmp = dpkt.icmp.ICMP(type=dpkt.icmp.ICMP_ECHO, data=dpkt.icmp.ICMP.Echo(id=index & 0xffff, seq=1, data=random_text(rng, 56)))
+            packets.append(ip_packet(client, server, dpkt.ip.IP_PROTO_ICMP, icmp))
+
+    return packets
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def replay(worker, packets, repeat=1):
+    latencies = []
+    verdicts = {'accept': 0, 'drop': 0, 'repeat': 0, 'none': 0}
+    total_bytes = 0
+
+    # Same as a live worker: the packet loop runs with the cyclic GC off
+    gc.collect()
+    gc.disable()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for payload in packets:
+            packet = ReplayPacket(payload)
+            packet_started = time.perf_counter_ns()
+            worker.packet_callback(packet)
+            latencies.append(time.perf_counter_ns() - packet_started)
+            verdicts[packet.verdict or 'none'] += 1
+            total_bytes += len(payload)
+    elapsed = time.perf_counter() - started
+    gc.enable()
+
+    latencies.sort()
+    return {
+        'packets': len(latencies),
+        'bytes': total_bytes,
+        'elapsed': elapsed,
+        'pps': len(latencies) / elapsed if elapsed else 0,
+        'mbps': total_bytes * 8 / elapsed / 1e6 if elapsed else 0,
+        'p50_us': percentile(latencies, 0.5) / 1000,
+        'p99_us': percentile(latencies, 0.99) / 1000,
+        'max_us': latencies[-1] / 1000 if latencies else 0,
+        'verdicts': verdicts
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a pcap or a synthetic corpus through the IPS pipeline without NFQUEUE')
+    parser.add_argument('--config', default='config.yaml', help='IPS config with the ruleset to benchmark')
+    parser.add_argument('--pcap', help='pcap/pcapng file to replay')
+    parser.add_argument('--synthetic', type=int, default=0, help='Generate a synthetic corpus with this many flows')
+    parser.add_argument('--attack-ratio', type=float, default=0.05, help='Fraction of synthetic flows carrying a signature')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for the synthetic corpus')
+    parser.add_argument('--write-pcap', help='Save the synthetic corpus to this pcap file')
+    parser.add_argument('--repeat', type=int, default=1, help='Replay the corpus this many times')
+    parser.add_argument('--log', action='store_true', help='Keep the logging and alert settings from the config instead of disabling them')
+
+    args = parser.parse_args()
+    if not args.pcap and not args.synthetic:
+        parser.error('either --pcap or --synthetic is required')
+
+    with open(args.config, 'r') as f:
+        config = yaml.safe_load(f)
+    if not args.log:
+        config['logging'] = dict(config.get('logging', {}), level='none')
+        config['alerts'] = dict(config.get('alerts', {}), format='none')
+
+    build_started = time.perf_counter()
+    matcher = MatcherEngine(config.get('matcher_backend', 'auto'))
+    matcher.add_rules(config.get('rules', []))
+    matcher.build()
+    print(f"Built matcher with {len(matcher.regex_rules)} rules in {(time.perf_counter() - build_started) * 1000:.1f} ms")
+
+    if args.pcap:
+        packets = read_pcap(args.pcap)
+    else:
+        packets = synthetic_corpus(matcher, args.synthetic, args.attack_ratio, args.seed)
+        if args.write_pcap:
+            write_pcap(args.write_pcap, packets)
+
+    if not packets:
+        print("No IP packets to replay")
+        sys.exit(1)
+
+    worker = PacketWorker(0, matcher, config)
+    report = replay(worker, packets, args.repeat)
+
+    print(f"Replayed {report['packets']} packets ({report['bytes'] / 1e6:.1f} MB) in {report['elapsed']:.2f} s")
+    print(f"  throughput: {report['pps']:.0f} packets/s, {report['mbps']:.1f} Mbit/s")
+    print(f"  latency: p50 {report['p50_us']:.1f} us, p99 {report['p99_us']:.1f} us, max {report['max_us']:.1f} us")
+    print("  verdicts: " + ", ".join(f"{verdict} {count}" for verdict, count in report['verdicts'].items()))
+
+    if worker.profiler is not None:
+        costs = sorted(((worker.stats[slot + RULE_SCAN_NS], worker.stats[slot + RULE_EVALUATIONS], rule_id)
+                        for rule_id, slot in worker.rule_slots.items()), reverse=True)
+        print("  costliest rules (profiled): " + ", ".join(
+            f"{rule_id} {scan_ns / 1e6:.1f} ms in {evaluations} scans" for scan_ns, evaluations, rule_id in costs[:5] if evaluations))
+
+if __name__ == '__main__':
+    main()
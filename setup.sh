@@ -107,9 +107,11 @@ show_iptables_setup() {
 
     QUEUES=$(grep "queues:" config.yaml | awk '{print $2}' 2>/dev/null || echo "4")
 
-    for ((i=0; i<$QUEUES; i++)); do
-        echo "iptables -I FORWARD -j NFQUEUE --queue-num $i"
-    done
+    if [[ $QUEUES -gt 1 ]]; then
+        echo "iptables -I FORWARD -j NFQUEUE --queue-balance 0:$((QUEUES - 1))"
+    else
+        echo "iptables -I FORWARD -j NFQUEUE --queue-num 0"
+    fi
 
     echo
     echo -e "${YELLOW}To monitor specific traffic only (recommended):${NC}"
@@ -117,9 +119,11 @@ show_iptables_setup() {
     echo "iptables -I FORWARD -p tcp --dport 443 -j NFQUEUE --queue-num 1"
     echo
     echo -e "${YELLOW}To remove rules later:${NC}"
-    for ((i=0; i<$QUEUES; i++)); do
-        echo "iptables -D FORWARD -j NFQUEUE --queue-num $i"
-    done
+    if [[ $QUEUES -gt 1 ]]; then
+        echo "iptables -D FORWARD -j NFQUEUE --queue-balance 0:$((QUEUES - 1))"
+    else
+        echo "iptables -D FORWARD -j NFQUEUE --queue-num 0"
+    fi
     echo
 }
 
@@ -0,0 +1,157 @@
+import multiprocessing as mp
+from bisect import bisect_left
+
+# Fixed per-worker layout of the shared counter block. Each worker is the only
+# writer of its own slots, so no locking is needed; readers see whole 64-bit values.
+WORKER_FIELDS = [
+    'packets_processed',
+    'matches_found',
+    'packets_dropped',
+    'packets_accepted',
+    'bytes_processed',
+    'active_flows',
+    'total_buffer_size',
+    'buffer_memory',
+    'retransmitted_bytes',
+    'out_of_order_segments',
+    'reassembly_gaps',
+    'expired_flows',
+    'evicted_flows',
+    'rejected_flows',
+    'memory_used',
+    'memory_pressure',
+    'truncated_flows',
+    'pressure_evictions',
+    'ruleset_generation',
+    'cached_verdicts',
+    'offloaded_flows',
+    'budget_exceeded',
+    'decoded_fields',
+    'decoder_failures',
+    'heartbeat',
+    'busy_since',
+    'worker_restarts',
+    'dropped_alerts',
+    'suppressed_alerts',
+    'rate_limited_packets',
+    'blocked_packets',
+    'source_bans',
+    'tracked_sources',
+    'pending_alerts'
+]
+
+PACKETS_PROCESSED = WORKER_FIELDS.index('packets_processed')
+MATCHES_FOUND = WORKER_FIELDS.index('matches_found')
+PACKETS_DROPPED = WORKER_FIELDS.index('packets_dropped')
+PACKETS_ACCEPTED = WORKER_FIELDS.index('packets_accepted')
+BYTES_PROCESSED = WORKER_FIELDS.index('bytes_processed')
+ACTIVE_FLOWS = WORKER_FIELDS.index('active_flows')
+TOTAL_BUFFER_SIZE = WORKER_FIELDS.index('total_buffer_size')
+BUFFER_MEMORY = WORKER_FIELDS.index('buffer_memory')
+RETRANSMITTED_BYTES = WORKER_FIELDS.index('retransmitted_bytes')
+OUT_OF_ORDER_SEGMENTS = WORKER_FIELDS.index('out_of_order_segments')
+REASSEMBLY_GAPS = WORKER_FIELDS.index('reassembly_gaps')
+EXPIRED_FLOWS = WORKER_FIELDS.index('expired_flows')
+EVICTED_FLOWS = WORKER_FIELDS.index('evicted_flows')
+REJECTED_FLOWS = WORKER_FIELDS.index('rejected_flows')
+MEMORY_USED = WORKER_FIELDS.index('memory_used')
+MEMORY_PRESSURE = WORKER_FIELDS.index('memory_pressure')
+TRUNCATED_FLOWS = WORKER_FIELDS.index('truncated_flows')
+PRESSURE_EVICTIONS = WORKER_FIELDS.index('pressure_evictions')
+RULESET_GENERATION = WORKER_FIELDS.index('ruleset_generation')
+CACHED_VERDICTS = WORKER_FIELDS.index('cached_verdicts')
+OFFLOADED_FLOWS = WORKER_FIELDS.index('offloaded_flows')
+BUDGET_EXCEEDED = WORKER_FIELDS.index('budget_exceeded')
+DECODED_FIELDS = WORKER_FIELDS.index('decoded_fields')
+DECODER_FAILURES = WORKER_FIELDS.index('decoder_failures')
+# time.monotonic_ns() of the last finished packet and of the start of the
+# packet in progress (0 while idle), for the supervisor to spot stuck workers
+HEARTBEAT = WORKER_FIELDS.index('heartbeat')
+BUSY_SINCE = WORKER_FIELDS.index('busy_since')
+WORKER_RESTARTS = WORKER_FIELDS.index('worker_restarts')
+DROPPED_ALERTS = WORKER_FIELDS.index('dropped_alerts')
+SUPPRESSED_ALERTS = WORKER_FIELDS.index('suppressed_alerts')
+RATE_LIMITED_PACKETS = WORKER_FIELDS.index('rate_limited_packets')
+BLOCKED_PACKETS = WORKER_FIELDS.index('blocked_packets')
+SOURCE_BANS = WORKER_FIELDS.index('source_bans')
+TRACKED_SOURCES = WORKER_FIELDS.index('tracked_sources')
+PENDING_ALERTS = WORKER_FIELDS.index('pending_alerts')
+
+# Histogram slots hold one count per bucket (not cumulative), the +Inf bucket
+# and the sum of observations in nanoseconds
+LATENCY_BUCKETS = [0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1]
+LATENCY_BUCKETS_NS = [int(bound * 1e9) for bound in LATENCY_BUCKETS]
+HISTOGRAM_SIZE = len(LATENCY_BUCKETS) + 2
+HISTOGRAMS = ['verdict_latency', 'scan_time']
+
+VERDICT_LATENCY = len(WORKER_FIELDS)
+SCAN_TIME = VERDICT_LATENCY + HISTOGRAM_SIZE
+RULE_STATS = SCAN_TIME + HISTOGRAM_SIZE
+
+# Per-rule slots after the histograms, one block of RULE_FIELDS per rule.
+# Everything but hits and disabled is only counted on profiled scans.
+RULE_FIELDS = [
+    'hits',
+    'evaluations',
+    'scan_ns',
+    'scanned_bytes',
+    'slow_scans',
+    'disabled'
+]
+
+RULE_HITS = RULE_FIELDS.index('hits')
+RULE_EVALUATIONS = RULE_FIELDS.index('evaluations')
+RULE_SCAN_NS = RULE_FIELDS.index('scan_ns')
+RULE_SCANNED_BYTES = RULE_FIELDS.index('scanned_bytes')
+RULE_SLOW_SCANS = RULE_FIELDS.index('slow_scans')
+RULE_DISABLED = RULE_FIELDS.index('disabled')
+
+def rule_ids(config):
+    ids = []
+    for rule in config.get('rules', []):
+        if rule['id'] not in ids:
+            ids.append(rule['id'])
+    return ids
+
+def block_size(rule_count):
+    return RULE_STATS + rule_count * len(RULE_FIELDS)
+
+def rule_slots(ids):
+    return {rule_id: RULE_STATS + index * len(RULE_FIELDS) for index, rule_id in enumerate(ids)}
+
+def observe(counters, histogram, elapsed_ns):
+    counters[histogram + bisect_left(LATENCY_BUCKETS_NS, elapsed_ns)] += 1
+    counters[histogram + HISTOGRAM_SIZE - 1] += elapsed_ns
+
+def local_counters(rule_count=0):
+    return memoryview(bytearray(8 * block_size(rule_count))).cast('Q')
+
+class SharedStats:
+    # Must be created before the workers and the metrics server are forked
+    def __init__(self, workers, rules=()):
+        self.workers = workers
+        self.rule_ids = list(rules)
+        self.block_size = block_size(len(self.rule_ids))
+        self.array = mp.RawArray('Q', workers * self.block_size)
+        self.view = memoryview(self.array).cast('B').cast('Q')
+
+    def worker(self, queue_id):
+        offset = queue_id * self.block_size
+        return self.view[offset:offset + self.block_size]
+
+    def read(self, queue_id):
+        counters = self.worker(queue_id)
+        stats = {name: counters[index] for index, name in enumerate(WORKER_FIELDS)}
+        stats['queue_id'] = queue_id
+        return stats
+
+    def read_histogram(self, queue_id, histogram):
+        counters = self.worker(queue_id)
+        offset = VERDICT_LATENCY + HISTOGRAMS.index(histogram) * HISTOGRAM_SIZE
+        buckets = counters[offset:offset + len(LATENCY_BUCKETS) + 1].tolist()
+        return buckets, counters[offset + HISTOGRAM_SIZE - 1] / 1e9
+
+    def read_rules(self, queue_id):
+        counters = self.worker(queue_id)
+        return {rule_id: {name: counters[slot + index] for index, name in enumerate(RULE_FIELDS)}
+                for rule_id, slot in rule_slots(self.rule_ids).items()}
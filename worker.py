@@ -1,36 +1,110 @@
 import os
 import gc
 import time
+import queue
+import pickle
+import signal
 import socket
-import os
-import dpkt
-from netfilterqueue import NetfilterQueue
-import syslog
+try:
+    from netfilterqueue import NetfilterQueue
+except ImportError:
+    # Offline replay (replay.py) drives packet_callback without a kernel queue
+    NetfilterQueue = None
 from reassembler import StreamReassembler
+from eventlog import EventLogger
+from alerts import AlertLog
+from blocklist import SourceTable, BANNED
+from profiler import RuleProfiler
+from control import ControlPlane
+from matcher import DECODED_STREAM
+from decoders import decoder_ports, new_decoder
+from packet import (parse_ip, TCP_HEADER, UDP_HEADER, PROTO_ICMP, PROTO_TCP, PROTO_UDP, PROTO_ICMPV6,
+                    TH_FIN, TH_SYN, TH_RST, TH_ACK, ICMPV6_ECHO_REQUEST, ICMPV6_ECHO_REPLY)
+from stats import (local_counters, observe, rule_ids, rule_slots, PACKETS_PROCESSED, MATCHES_FOUND,
+                   PACKETS_DROPPED, PACKETS_ACCEPTED, BYTES_PROCESSED, ACTIVE_FLOWS,
+                   TOTAL_BUFFER_SIZE, BUFFER_MEMORY, PENDING_ALERTS, VERDICT_LATENCY,
+                   SCAN_TIME, RULE_HITS, RULE_DISABLED, RETRANSMITTED_BYTES, OUT_OF_ORDER_SEGMENTS,
+                   REASSEMBLY_GAPS, EXPIRED_FLOWS, EVICTED_FLOWS, REJECTED_FLOWS,
+                   MEMORY_USED, MEMORY_PRESSURE, TRUNCATED_FLOWS, PRESSURE_EVICTIONS,
+                   RULESET_GENERATION, CACHED_VERDICTS, OFFLOADED_FLOWS, BUDGET_EXCEEDED,
+                   HEARTBEAT, BUSY_SINCE, DECODED_FIELDS, DECODER_FAILURES, DROPPED_ALERTS,
+                   SUPPRESSED_ALERTS, RATE_LIMITED_PACKETS, BLOCKED_PACKETS, SOURCE_BANS,
+                   TRACKED_SOURCES, WORKER_FIELDS)
+
+# Packet/conntrack mark bits for flow offload: a direction that is clean past
+# the inspection depth, or a connection that was dropped
+OFFLOAD_ORIGINAL = 0x1
+OFFLOAD_REPLY = 0x2
+OFFLOAD_DROP = 0x4
+
+# netfilter hook of packets queued from the INPUT chain (packet.hook)
+NF_INET_LOCAL_IN = 1
+
+class InspectionTimeout(Exception):
+    pass
 
 class PacketWorker:
-    def __init__(self, queue_id, matcher_engine, config):
+    def __init__(self, queue_id, matcher_engine, config, stats=None, reload_queue=None, generation=None):
         self.queue_id = queue_id
         self.matcher = matcher_engine
         self.config = config
         self.reassembler = StreamReassembler(
             max_buffer_size=config.get('max_buffer_size', 65536),
-            flow_timeout=config.get('flow_timeout', 60)
+            flow_timeout=config.get('flow_timeout', 60),
+            scan_window=matcher_engine.window_size(config.get('max_scan_window', 8192)),
+            max_ooo_segments=config.get('tcp_max_ooo_segments', 32),
+            max_ooo_bytes=config.get('tcp_max_ooo_bytes', 65536),
+            overlap_policy=config.get('tcp_overlap_policy', 'first'),
+            max_flows=config.get('max_flows', 100000),
+            eviction_policy=config.get('flow_eviction', 'lru'),
+            closed_timeout=config.get('flow_closed_timeout', 10),
+            memory_budget=config.get('reassembly_memory_budget', 0),
+            pressure_inspect_bytes=config.get('pressure_inspect_bytes', 16384)
         )
-        self.nfqueue = NetfilterQueue()
-        self.stats = {
-            'packets_processed': 0,
-            'matches_found': 0,
-            'packets_dropped': 0,
-            'packets_accepted': 0
-        }
-        self.alerts = []
-        self.last_prune = time.time()
-        self.last_log_flush = time.time()
+        self.nfqueue = NetfilterQueue() if NetfilterQueue is not None else None
+        self.rule_slots = rule_slots(rule_ids(config))
+        self.stats = stats if stats is not None else local_counters(len(self.rule_slots))
+        self.profiler = None
+        sample_rate = config.get('rule_profile_sample_rate', 0)
+        if sample_rate > 0:
+            self.profiler = RuleProfiler(
+                self.stats, self.rule_slots, max(1, int(1 / sample_rate)),
+                slow_threshold_ns=int(config.get('slow_rule_threshold_us', 0) * 1000),
+                slow_strikes=config.get('slow_rule_strikes', 3)
+            )
+            matcher_engine.profiler = self.profiler
+        self.slow_rule_action = config.get('slow_rule_action', 'flag')
+        self.decoder_ports = decoder_ports(config)
+        self.blocklist = SourceTable(config) if config.get('blocklist', {}).get('enabled', False) else None
+        # Matching is the one part of a packet without a bound on its run time;
+        # SIGALRM interrupts it once the budget is spent (re checks for signals
+        # while it matches) and the packet is accepted
+        self.packet_budget = config.get('packet_budget_ms', 0) / 1000
+        if self.packet_budget:
+            signal.signal(signal.SIGALRM, self.budget_expired)
+        self.alerts = AlertLog(config, queue_id)
+        self.events = EventLogger(config, queue_id)
+        self.control = ControlPlane(self, config.get('housekeeping_interval', 1.0),
+                                    config.get('alerts', {}).get('flush_interval', 1.0))
+        self.expire_slice = config.get('flow_expire_slice', 256)
+        self.inspect_depth = config.get('flow_inspect_depth', 0)
+        self.offload_enabled = config.get('flow_offload', 'none') == 'connmark'
+        self.reload_queue = reload_queue
+        self.generation = generation
+        self.ruleset_generation = generation.value if generation is not None else 0
+        self.stats[RULESET_GENERATION] = self.ruleset_generation
         
 
     def setup(self):
-        self.nfqueue.bind(self.queue_id, self.packet_callback)
+        self.nfqueue.bind(
+            self.queue_id, self.packet_callback,
+            max_len=self.config.get('nfqueue_max_len', 10000),
+            sock_len=self.config.get('nfqueue_rcvbuf', 8 * 1024 * 1024)
+        )
+        self.events.start()
+        self.control.start()
+        self.stats[BUSY_SINCE] = 0
+        self.stats[HEARTBEAT] = time.monotonic_ns()
         gc.disable()
         try:
             os.sched_setaffinity(0, {self.queue_id % os.cpu_count()})
@@ -38,161 +112,401 @@ class PacketWorker:
             pass
 
     def packet_callback(self, packet):
+        # Inspect and verdict only; housekeeping queued by the control plane
+        # runs after the verdict is out
+        control = self.control
+        control.busy = True
+        started = time.monotonic_ns()
+        self.stats[BUSY_SINCE] = started
+        result = self.process_packet(packet)
+        finished = time.monotonic_ns()
+        observe(self.stats, VERDICT_LATENCY, finished - started)
+        self.stats[HEARTBEAT] = finished
+        self.stats[BUSY_SINCE] = 0
+        if control.tasks:
+            control.run_tasks()
+        control.busy = False
+        return result
+
+    def handle_slow_rules(self):
+        disabled = False
+        for rule_id in self.profiler.slow_rules:
+            if self.slow_rule_action == 'disable':
+                self.matcher.disable_rule(rule_id)
+                self.stats[self.rule_slots[rule_id] + RULE_DISABLED] = 1
+                self.events.error(None, None, None, f"Rule {rule_id} disabled: slower than the slow rule threshold")
+                disabled = True
+            else:
+                self.events.error(None, None, None, f"Rule {rule_id} is slower than the slow rule threshold")
+        self.profiler.slow_rules = []
+        if disabled:
+            self.set_matcher(self.matcher)
+
+    def ban_check(self, src_ip, dst_ip, protocol):
+        duration = self.blocklist.hit(src_ip, time.monotonic())
+        if duration is not None:
+            self.stats[SOURCE_BANS] += 1
+            self.events.drop(src_ip, dst_ip, protocol, f"Source banned for {duration}s after repeated rule hits")
+
+    def push_bans(self):
+        # Control thread
+        error = self.blocklist.push_bans()
+        if error:
+            self.events.error(None, None, None, f"Adding banned sources to the ipset failed: {error}")
+
+    def budget_expired(self, signum, frame):
+        raise InspectionTimeout()
+
+    def scan(self, match, *args):
+        if self.packet_budget:
+            signal.setitimer(signal.ITIMER_REAL, self.packet_budget)
+        started = time.perf_counter_ns()
+        try:
+            return match(*args)
+        finally:
+            if self.packet_budget:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+            observe(self.stats, SCAN_TIME, time.perf_counter_ns() - started)
+
+    def decode(self, flow, data, protocol, src_port, dst_port):
+        # Field rules are matched against each buffer the decoder extracts from
+        # the new bytes; once the decoder fails they go back to the raw stream
+        matches = []
+        for field, value in flow.decoder.feed(data):
+            self.stats[DECODED_FIELDS] += 1
+            if field not in self.matcher.fields:
+                continue
+            matches.extend(self.scan(self.matcher.match, value, protocol, src_port, dst_port, field))
+        if flow.decoder.failed:
+            flow.decoder = None
+            self.stats[DECODER_FAILURES] += 1
+        return matches
+
+    def receive_ruleset(self, timeout):
+        # Control thread: waits up to timeout for a ruleset from the parent and
+        # unpickles the newest one queued
+        if self.reload_queue is None:
+            self.control.stop_event.wait(timeout)
+            return None
+
+        ruleset = None
+        try:
+            generation, ruleset = self.reload_queue.get(timeout=timeout)
+            while True:
+                generation, ruleset = self.reload_queue.get_nowait()
+        except queue.Empty:
+            pass
+        except (OSError, ValueError):
+            return None
+
+        if ruleset is None:
+            return None
+        return generation, pickle.loads(ruleset)
+
+    def swap_ruleset(self, generation, matcher_engine):
+        self.set_matcher(matcher_engine)
+        self.ruleset_generation = generation
+        self.stats[RULESET_GENERATION] = generation
+
+    def expire_flows(self):
+        self.reassembler.expire_flows(time.time(), self.expire_slice)
+
+    def set_matcher(self, matcher_engine):
+        if self.profiler is not None and matcher_engine is not self.matcher:
+            # A new ruleset starts with a clean slow rule record
+            self.profiler.reset()
+            for slot in self.rule_slots.values():
+                self.stats[slot + RULE_DISABLED] = 0
+        if self.profiler is not None:
+            matcher_engine.profiler = self.profiler
+        self.matcher = matcher_engine
+        self.reassembler.reset_streams(matcher_engine.window_size(self.config.get('max_scan_window', 8192)))
+
+    def process_packet(self, packet):
         try:
-            self.stats['packets_processed'] += 1
+            self.stats[PACKETS_PROCESSED] += 1
+            src_ip = dst_ip = protocol = flow = None
             raw_data = packet.get_payload()
+            view = memoryview(raw_data)
+            self.stats[BYTES_PROCESSED] += len(raw_data)
 
             try:
-                ip = dpkt.ip.IP(raw_data)
-                src_ip = socket.inet_ntoa(ip.src)
-                dst_ip = socket.inet_ntoa(ip.dst)
-
-                protocol = None
+                parsed = parse_ip(raw_data)
+                if parsed is None:
+                    packet.accept()
+                    self.stats[PACKETS_ACCEPTED] += 1
+                    self.events.accept(src_ip, dst_ip, protocol, "No transport header to inspect")
+                    return
+
+                # Addresses are kept as raw bytes; the event writer formats them
+                src_ip, dst_ip, ip_protocol, header_len, ip_end = parsed
+                # Only sources of inbound packets are tracked; on OUTPUT the
+                # source is this host
+                inbound = self.blocklist is not None and packet.hook == NF_INET_LOCAL_IN
+                if inbound:
+                    reason = self.blocklist.check(src_ip, time.monotonic())
+                    if reason is not None:
+                        packet.drop()
+                        self.stats[PACKETS_DROPPED] += 1
+                        self.stats[BLOCKED_PACKETS if reason is BANNED else RATE_LIMITED_PACKETS] += 1
+                        self.events.drop(src_ip, dst_ip, protocol, reason)
+                        return
                 src_port = dst_port = 0
-                payload = b''
-
+                matches = None
 
-                if ip.p == dpkt.ip.IP_PROTO_TCP:
-                    tcp = ip.data
+                if ip_protocol == PROTO_TCP:
                     protocol = 'tcp'
-                    src_port = tcp.sport
-                    dst_port = tcp.dport
-                    payload = tcp.data
+                    src_port, dst_port, seq, data_offset, flags = TCP_HEADER.unpack_from(raw_data, header_len)
+                    payload = view[header_len + (data_offset >> 4) * 4:ip_end]
 
                     flow_key = self.reassembler.get_flow_key(
-                        src_ip, src_port, dst_ip, dst_port, protocol
+                        src_ip, src_port, dst_ip, dst_port, ip_protocol
                     )
 
-                    buffer = self.reassembler.add_tcp_segment(flow_key, payload)
-                    scan_data = self.reassembler.get_buffer(
-                        flow_key, self.config.get('max_scan_window', 8192)
+                    if flags & (TH_SYN | TH_ACK) == TH_SYN:
+                        self.reassembler.reset_flow(flow_key, seq)
+                    flow = self.reassembler.cached_flow(flow_key)
+                    if flow is not None:
+                        if flags & (TH_FIN | TH_RST):
+                            self.reassembler.close_flow(flow_key)
+                        self.flow_verdict(packet, flow, src_ip, dst_ip, src_port, dst_port, protocol)
+                        return
+
+                    buffer, count = self.reassembler.add_tcp_segment(
+                        flow_key, payload, seq, flags & TH_SYN
                     )
-
-                    if tcp.flags & dpkt.tcp.TH_FIN or tcp.flags & dpkt.tcp.TH_RST:
-                        self.reassembler.close_flow(flow_key)
-
-                elif isinstance(ip.data, dpkt.icmp.ICMP):
-                    scan_data = bytearray(bytes(ip.data.data))
+                    flow = self.reassembler.get_flow(flow_key)
+                    scan_data = buffer
+
+                    # Without a flow (table full, new flows rejected), or when the
+                    # reassembler could not hold it back, the segment is matched
+                    # on its own further down
+                    if flow is not None and count is not None:
+                        if flags & TH_SYN:
+                            flow.ct_dir = 'reply' if flags & TH_ACK else 'original'
+                            # Only flows seen from the handshake are decoded, so a
+                            # decoder never starts in the middle of a message
+                            if flow.ct_dir == 'original' and dst_port in self.decoder_ports:
+                                flow.decoder = new_decoder(self.decoder_ports[dst_port], self.config)
+                        if flow.scan_state is None:
+                            flow.scan_state = self.matcher.new_stream()
+
+                        max_window = self.config.get('max_scan_window', 8192)
+                        matches = self.scan(
+                            self.matcher.match_stream, flow.scan_state, buffer, count, protocol,
+                            max_window, src_port, dst_port,
+                            DECODED_STREAM if flow.decoder is not None else None
+                        )
+                        if flow.decoder is not None and count:
+                            matches = matches + self.decode(flow, buffer[len(buffer) - count:], protocol, src_port, dst_port)
+                            if flow.decoder is None:
+                                # The decoder gave up: the field rules get the raw
+                                # stream, starting over from the retained bytes
+                                flow.scan_state = self.matcher.new_stream()
+                                matches = matches + self.scan(
+                                    self.matcher.match_stream, flow.scan_state, buffer, count, protocol,
+                                    max_window, src_port, dst_port
+                                )
+
+                        if flags & (TH_FIN | TH_RST):
+                            self.reassembler.close_flow(flow_key)
+
+                        drop_rules = [match['rule_id'] for match in matches if match['action'] == 'drop']
+                        if drop_rules:
+                            self.reassembler.set_verdict(flow, 'drop', drop_rules)
+                        elif self.inspect_depth and flow.delivered >= self.inspect_depth:
+                            self.reassembler.set_verdict(flow, 'accept')
+
+                elif ip_protocol == PROTO_ICMP or (ip_protocol == PROTO_ICMPV6 and ip_end > header_len
+                                                   and raw_data[header_len] in (ICMPV6_ECHO_REQUEST, ICMPV6_ECHO_REPLY)):
+                    # Every ICMPv4 message, but only ICMPv6 echo: the rest of
+                    # ICMPv6 (neighbour discovery, PMTU) has to get through
+                    scan_data = view[header_len + 4:ip_end]
                     if len(scan_data) != 60:
                         packet.drop()
-                        self.stats['packets_dropped'] += 1
-                        syslog.syslog(f"[DROP] {src_ip} -> {dst_ip}; proto: {protocol}; Strange icmp requestclea")
+                        self.stats[PACKETS_DROPPED] += 1
+                        self.events.drop(src_ip, dst_ip, protocol, "Strange icmp request")
+                        return
 
-                elif ip.p == dpkt.ip.IP_PROTO_UDP: 
-                    udp = ip.data
+                elif ip_protocol == PROTO_UDP:
                     protocol = 'udp'
-                    src_port = udp.sport
-                    dst_port = udp.dport
-                    payload = udp.data
+                    src_port, dst_port = UDP_HEADER.unpack_from(raw_data, header_len)
+                    payload = view[header_len + 8:ip_end]
 
                     flow_key = self.reassembler.get_flow_key(
-                        src_ip, src_port, dst_ip, dst_port, protocol
+                        src_ip, src_port, dst_ip, dst_port, ip_protocol
                     )
 
                     scan_data = self.reassembler.add_udp_datagram(flow_key, payload)
 
                 else:
                     packet.accept()
-                    self.stats['packets_accepted'] += 1
-                    syslog.syslog(1, f"[ACCEPT] {src_ip} -> {dst_ip} proto: {protocol}; Uncheckable protocol")
-                    return "1" + ip.get_proto(ip.p)
-                
+                    self.stats[PACKETS_ACCEPTED] += 1
+                    self.events.accept(src_ip, dst_ip, protocol, "Uncheckable protocol")
+                    return
 
                 if not scan_data:
                     packet.accept()
-                    self.stats['packets_accepted'] += 1
-                    syslog.syslog(1, f"[ACCEPT] {src_ip} -> {dst_ip}; proto: {protocol}; No scan data present")
-                    return "2" + ip.get_proto(ip.p)
-
-                matches = self.matcher.match(scan_data, protocol)
-                if len(matches) > 0:
-                    for match in matches:
-                        if match['action'] == 'drop' and len(match['matches']) > 0:
-                            #self.log_match(match, flow_key, src_ip, dst_ip, src_port, dst_port, protocol)
-                            packet.drop()
-                            syslog.syslog(f"[DROP] {src_ip} -> {dst_ip}; proto: {protocol}; Found matches: {matches}")
-                            self.stats['packets_dropped'] += 1
-                            self.stats['matches_found'] += 1
-                            return
-                
+                    self.stats[PACKETS_ACCEPTED] += 1
+                    self.events.accept(src_ip, dst_ip, protocol, "No scan data present")
+                    return
+
+                if matches is None:
+                    matches = self.scan(self.matcher.match, scan_data, protocol, src_port, dst_port)
+                # The verdict is issued before the alerts are recorded, so a
+                # failure recording them can't turn a drop into an accept
+                if any(match['action'] == 'drop' and len(match['matches']) > 0 for match in matches):
+                    packet.drop()
+                    self.stats[PACKETS_DROPPED] += 1
+                    self.stats[MATCHES_FOUND] += 1
+                    self.events.drop(src_ip, dst_ip, protocol, "Found matches", [m['rule_id'] for m in matches])
+                    if inbound:
+                        self.ban_check(src_ip, dst_ip, protocol)
+                    for hit in matches:
+                        if hit['rule_id'] in self.rule_slots:
+                            self.stats[self.rule_slots[hit['rule_id']] + RULE_HITS] += 1
+                else:
+                    packet.accept()
+                    self.stats[PACKETS_ACCEPTED] += 1
+                    self.events.accept(src_ip, dst_ip, protocol, "Packet doesnt match any rules")
+                self.record_alerts(matches, src_ip, dst_ip, src_port, dst_port, ip_protocol)
+                return
 
+            except InspectionTimeout:
+                # Drop rules that already matched on the stream still drop it;
+                # otherwise only this packet goes through uninspected, and the
+                # rule the scan was stuck in is skipped for the rest of the flow
+                self.stats[BUDGET_EXCEEDED] += 1
+                drop_rules = []
+                if flow is not None and flow.scan_state is not None:
+                    drop_rules = [match['rule_id'] for match in self.matcher.stream_hits(flow.scan_state)
+                                  if match['action'] == 'drop']
+                    self.matcher.skip_running(flow.scan_state)
+                if drop_rules:
+                    self.reassembler.set_verdict(flow, 'drop', drop_rules)
+                    packet.drop()
+                    self.stats[PACKETS_DROPPED] += 1
+                    self.stats[MATCHES_FOUND] += 1
+                    self.events.drop(src_ip, dst_ip, protocol, "Inspection budget exceeded after matches", drop_rules)
+                    return
                 packet.accept()
-                self.stats['packets_accepted'] += 1
-                syslog.syslog(f"[ACCEPT] {src_ip} -> {dst_ip}; proto: {protocol}; Packet doesnt match any rules")
+                self.stats[PACKETS_ACCEPTED] += 1
+                self.events.error(src_ip, dst_ip, protocol, "Inspection budget exceeded, packet accepted")
+                return
 
             except Exception as e:
                 packet.accept()
-                self.stats['packets_accepted'] += 1
-                syslog.syslog(f"[ERROR] {src_ip} -> {dst_ip}; Error: {str(e)}")
+                self.stats[PACKETS_ACCEPTED] += 1
+                self.events.error(src_ip, dst_ip, protocol, f"Error: {e}")
                 return
 
         except Exception as e:
             try:
                 packet.accept()
-                self.stats['packets_accepted'] += 1
-                syslog.syslog(f"[ERROR] {src_ip} -> {dst_ip}; Error: {str(e)}")
+                self.stats[PACKETS_ACCEPTED] += 1
+                self.events.error(src_ip, dst_ip, protocol, f"Error: {e}")
                 return 
             except:
                 pass
 
-        current_time = time.time()
-        if current_time - self.last_prune > 30:
-            self.reassembler.prune_flows()
-            self.last_prune = current_time
-
-
-        if current_time - self.last_log_flush > self.config.get('log_flush_interval', 60):
-            self.flush_logs()
-            self.last_log_flush = current_time
-
-
-    def log_match(self, match, flow_key, src_ip, dst_ip, src_port, dst_port, protocol):
-        alert = {
-            'timestamp': time.time(),
-            'rule_id': match['rule_id'],
-            'src_ip': src_ip,
-            'dst_ip': dst_ip,
-            'src_port': src_port,
-            'dst_port': dst_port,
-            'protocol': protocol,
-            'offset': match['offset'],
-            'action': match['action'],
-            'type': match['type']
-        }
-        self.alerts.append(alert)
-
-
-    def flush_logs(self):
-        if not self.alerts:
+    def flow_verdict(self, packet, flow, src_ip, dst_ip, src_port, dst_port, protocol):
+        self.stats[CACHED_VERDICTS] += 1
+        if flow.verdict == 'drop':
+            self.stats[PACKETS_DROPPED] += 1
+            self.stats[MATCHES_FOUND] += 1
+            for rule_id in flow.verdict_rules:
+                if rule_id in self.rule_slots:
+                    self.stats[self.rule_slots[rule_id] + RULE_HITS] += 1
+            self.events.drop(src_ip, dst_ip, protocol, "Flow already dropped", flow.verdict_rules)
+            if not self.offload(packet, flow, OFFLOAD_DROP):
+                packet.drop()
+            self.record_alerts([{'rule_id': rule_id, 'action': 'drop'} for rule_id in flow.verdict_rules],
+                               src_ip, dst_ip, src_port, dst_port, PROTO_TCP)
             return
 
-        timestamp = int(time.time())
-        filename = f"alerts_{timestamp}_q{self.queue_id}.csv"
+        self.stats[PACKETS_ACCEPTED] += 1
+        self.events.accept(src_ip, dst_ip, protocol, "Flow inspected past depth")
+        mark = OFFLOAD_ORIGINAL if flow.ct_dir == 'original' else OFFLOAD_REPLY if flow.ct_dir == 'reply' else 0
+        if not mark or not self.offload(packet, flow, mark):
+            packet.accept()
 
+    def record_alerts(self, matches, src_ip, dst_ip, src_port, dst_port, ip_protocol):
+        # Called once the packet has its verdict
+        now = time.time()
         try:
-            with open(filename, 'w') as f:
-                f.write("timestamp,rule_id,src_ip,dst_ip,src_port,dst_port,protocol,offset,action,type\n")
-                for alert in self.alerts:
-                    f.write(f"{alert['timestamp']},{alert['rule_id']},{alert['src_ip']},{alert['dst_ip']},{alert['src_port']},{alert['dst_port']},{alert['protocol']},{alert['offset']},{alert['action']},{alert['type']}\n")
-            self.alerts.clear()
+            for match in matches:
+                self.alerts.hit(now, match['rule_id'], match['action'], src_ip, dst_ip, src_port, dst_port, ip_protocol)
         except Exception as e:
-            pass
+            self.events.error(src_ip, dst_ip, None, f"Recording alerts failed: {e}")
+
+    def offload(self, packet, flow, mark):
+        # The packet goes back through the hook with the mark set; the rules in
+        # front of NFQUEUE copy it to the connection and decide it, and every
+        # later packet of that direction (or connection, for drops) from there on
+        if not self.offload_enabled:
+            return False
+
+        current = packet.get_mark()
+        if current & mark:
+            # Already marked once and queued again: the mark rules did not catch
+            # it (conntrack entry in the other direction, NOTRACK, wrong ct_dir),
+            # so repeating would loop it through the queue forever
+            return False
+        packet.set_mark(current | mark)
+        packet.repeat()
+        if not flow.offloaded:
+            flow.offloaded = True
+            self.stats[OFFLOADED_FLOWS] += 1
+        return True
+
+    def update_flow_stats(self):
+        reassembler = self.reassembler
+        self.stats[ACTIVE_FLOWS] = len(reassembler.flows)
+        self.stats[TOTAL_BUFFER_SIZE] = reassembler.buffered_bytes
+        self.stats[BUFFER_MEMORY] = reassembler.buffer_memory
+        self.stats[RETRANSMITTED_BYTES] = reassembler.retransmitted_bytes
+        self.stats[OUT_OF_ORDER_SEGMENTS] = reassembler.out_of_order_segments
+        self.stats[REASSEMBLY_GAPS] = reassembler.reassembly_gaps
+        self.stats[EXPIRED_FLOWS] = reassembler.expired_flows
+        self.stats[EVICTED_FLOWS] = reassembler.evicted_flows
+        self.stats[REJECTED_FLOWS] = reassembler.rejected_flows
+        self.stats[MEMORY_USED] = reassembler.memory_used()
+        self.stats[MEMORY_PRESSURE] = int(reassembler.under_pressure)
+        self.stats[TRUNCATED_FLOWS] = reassembler.truncated_flows
+        self.stats[PRESSURE_EVICTIONS] = reassembler.pressure_evictions
+        if self.blocklist is not None:
+            self.stats[TRACKED_SOURCES] = len(self.blocklist.sources)
 
+    def flush_logs(self):
+        # Control thread
+        try:
+            self.alerts.flush()
+        except Exception as e:
+            self.events.error(None, None, None, f"Alert flush failed: {e}")
+        self.stats[PENDING_ALERTS] = self.alerts.pending()
+        self.stats[DROPPED_ALERTS] = self.alerts.overflows
+        self.stats[SUPPRESSED_ALERTS] = self.alerts.suppressed
 
     def run(self):
         self.setup()
         try:
-            self.nfqueue.run()
+            # run_socket drains the netlink socket in a tight recv loop and keeps
+            # going on ENOBUFS instead of stalling when the socket buffer overflows
+            sock = socket.fromfd(self.nfqueue.get_fd(), socket.AF_UNIX, socket.SOCK_STREAM)
+            self.nfqueue.run_socket(sock)
         except KeyboardInterrupt:
             pass
         finally:
-            self.flush_logs()
+            self.control.stop()
+            self.alerts.close()
+            self.events.close()
             self.nfqueue.unbind()
 
 
     def get_stats(self):
-        stats = self.stats.copy()
+        stats = {name: self.stats[index] for index, name in enumerate(WORKER_FIELDS)}
         stats.update(self.reassembler.get_stats())
         stats['queue_id'] = self.queue_id
-        stats['pending_alerts'] = len(self.alerts)
+        stats['pending_alerts'] = self.alerts.pending()
+        stats.update(self.events.get_stats())
         return stats